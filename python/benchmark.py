@@ -0,0 +1,360 @@
+from __future__ import annotations
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from evaluator import ESQLCoverageEvaluator, peak_rss_kb
+
+HERE = Path(__file__).resolve().parent
+TRACE_STYLES = ("user", "service", "mixed")
+# Phases of ESQLCoverageEvaluator.run(), as timed by its RunStats
+PHASES = ("discover", "extract", "process", "report")
+
+# -----------------------------
+# Synthetic ESQL source
+# -----------------------------
+
+class SourceGenerator:
+    """Random but reproducible ESQL with nested control blocks, labels, comments and continuations."""
+
+    def __init__(self, rng: random.Random, max_depth: int, statements: Tuple[int, int] = (2, 6)):
+        self.rng = rng
+        self.max_depth = max_depth
+        self.statements = statements
+        self.labels = 0
+        self.in_atomic = False
+
+    def body(self, depth: int = 0) -> List[Tuple[str, bool]]:
+        """(line, starts a statement) pairs; only statement starts appear in an ACE trace."""
+        r = self.rng
+        ind = "\t" * (depth + 2)
+        nested = depth < self.max_depth
+        out: List[Tuple[str, bool]] = []
+        for i in range(r.randint(*self.statements)):
+            k = r.random()
+            if k < 0.14 and nested:
+                out.append((f"{ind}IF Environment.V{i} > {i} THEN", True))
+                out += self.body(depth + 1)
+                if r.random() < 0.4:
+                    out.append((f"{ind}ELSEIF Environment.W = {i} THEN", False))
+                    out += self.body(depth + 1)
+                if r.random() < 0.5:
+                    out.append((f"{ind}ELSE", False))
+                    out += self.body(depth + 1)
+                out.append((f"{ind}END IF;", False))
+            elif k < 0.20 and nested:
+                out.append((f"{ind}CASE Environment.C{i}", True))
+                for w in range(r.randint(1, 3)):
+                    out.append((f"{ind}\tWHEN {w} THEN", False))
+                    out += self.body(depth + 2)
+                out.append((f"{ind}END CASE;", False))
+            elif k < 0.25 and nested:
+                label = self.label()
+                out.append((f"{ind}{label} : LOOP", True))
+                out += self.body(depth + 1)
+                out.append((f"{ind}\tLEAVE {label};", True))
+                out.append((f"{ind}END LOOP {label};", False))
+            elif k < 0.29 and nested:
+                out.append((f"{ind}WHILE I < {i + 3} DO", True))
+                out += self.body(depth + 1)
+                out.append((f"{ind}END WHILE;", False))
+            elif k < 0.32 and nested:
+                out.append((f"{ind}FOR ref{depth} AS InputRoot.XMLNSC.Item[] DO", True))
+                out += self.body(depth + 1)
+                out.append((f"{ind}END FOR;", False))
+            elif k < 0.35 and nested:
+                out.append((f"{ind}REPEAT", True))
+                out += self.body(depth + 1)
+                out.append((f"{ind}UNTIL I > {i}", False))
+                out.append((f"{ind}END REPEAT;", False))
+            elif k < 0.37 and nested and not self.in_atomic:
+                # Unlabelled and not nested: the evaluator (like the Perl script) ends an ATOMIC
+                # block at the next 'END;', a labelled 'END <label>;' would end the procedure
+                self.in_atomic = True
+                out.append((f"{ind}BEGIN ATOMIC", True))
+                out += self.body(depth + 1)
+                out.append((f"{ind}END;", False))
+                self.in_atomic = False
+            elif k < 0.42:
+                out.append((f"{ind}-- IF this comment were code it would open a block {i}", False))
+            elif k < 0.45:
+                out.append((f"{ind}/* block comment", False))
+                out.append((f"{ind}   END IF; CASE inside a comment */", False))
+            elif k < 0.48:
+                out.append(("", False))
+            elif k < 0.54:
+                out.append((f"{ind}SET OutputRoot.XMLNSC.Msg.T{i} = 'a;'", True))
+                out.append((f"{ind}\t|| Environment.Suffix;", False))
+            else:
+                out.append((f"{ind}SET OutputRoot.XMLNSC.Msg.F{i} = '{i}';", True))
+        return out
+
+    def label(self) -> str:
+        self.labels += 1
+        return f"L{self.labels}"
+
+
+def generate_esql(rng: random.Random, schemas: int, modules: int, procedures: int,
+                  max_depth: int) -> Tuple[List[str], List[Tuple[str, List[str], List[int]]]]:
+    """Source lines of a CMF-like file, and per function/procedure its qualified name, body lines
+    and the indexes of the body lines that start a statement (the lines a trace can name)."""
+    gen = SourceGenerator(rng, max_depth)
+    src: List[str] = []
+    functions: List[Tuple[str, List[str], List[int]]] = []
+    for s in range(schemas):
+        schema = f"com.bench.s{s}"
+        src.append(f'CREATE SCHEMA {schema} PATH ""')
+        src.append("")
+        for m in range(modules):
+            module = f"Flow{m}_Compute"
+            src.append(f"CREATE COMPUTE MODULE {module}")
+            for p in range(procedures):
+                if p == 0:
+                    name = "Main"
+                    src.append(f"\tCREATE FUNCTION {name}() RETURNS BOOLEAN")
+                    lines = [("\tBEGIN", True)] + gen.body() + [("\t\tRETURN TRUE;", True), ("\tEND;", False)]
+                else:
+                    name = f"Proc{p}"
+                    src.append(f"\tCREATE PROCEDURE {name}(IN P{p} CHARACTER) BEGIN")
+                    lines = gen.body() + [("\tEND;", False)]
+                body = [line for line, _ in lines]
+                src += body
+                src.append("")
+                functions.append((f"{schema}.{module}.{name}", body, [n for n, (_, start) in enumerate(lines) if start]))
+            src.append("END MODULE;")
+            src.append("")
+    return src, functions
+
+
+# -----------------------------
+# Synthetic trace
+# -----------------------------
+
+NOISE_LINES = (
+    "BIP6060I: Parser type ''Properties'' created on behalf of node 'Flow.Compute' to handle portion of "
+    "incoming message of length 0 bytes beginning at offset '0'. ",
+    "BIP2632I: Message received and propagated to 'out' terminal of MQ input node 'Flow.IN'. ",
+    "BIP2231E: Error detected whilst processing a message in node 'Flow.Compute'. ",
+)
+
+
+def generate_trace(rng: random.Random, functions: List[Tuple[str, List[str], List[int]]], hits: int,
+                   noise: float, style: str) -> Iterator[str]:
+    """UserTrace and/or ServiceTrace lines with `hits` statement records; noise is the share of other lines."""
+    yield "Timestamps are formatted in local time."
+    yield ""
+    # A body of only comments has no statement to trace
+    functions = [f for f in functions if f[2]]
+    # Hot functions get most of the hits, as in real flows
+    cum_weights = []
+    total = 0.0
+    for i in range(len(functions)):
+        total += 1.0 / (i + 1)
+        cum_weights.append(total)
+    noise_per_hit = noise / (1.0 - noise)
+    for h in range(hits):
+        func, body, statements = rng.choices(functions, cum_weights=cum_weights)[0]
+        n = rng.choice(statements)
+        stmt = body[n].strip().replace("'", "''")
+        stamp = f"2025-09-02 10:{(h // 60000) % 60:02d}:{(h // 1000) % 60:02d}.{h % 1000000:06d}"
+        thread = rng.choice((400, 2864, 502564))
+        service = style == "service" or (style == "mixed" and rng.random() < 0.5)
+        if service:
+            yield (f"{stamp}   {thread}   SqlAssignment::execute (0007AB24-68B6A3CE-00000016)  "
+                   f"file:/build/ImbRdlAssignment.cpp line:118 message:2537.BIPmsgs "
+                   f"X#FCMComposite_1_4 ComIbmComputeNode, 'Executing statement at (&1, &2)', "
+                   f"'{func}', '{n + 1}.4'")
+            yield (f"{stamp}   {thread}   UserTrace   BIP2537I: Node 'Flow.Compute': Executing statement   "
+                   f"'{stmt}' at ({func}, {n + 1}.4). ")
+        else:
+            yield (f"{stamp}   {thread}   UserTrace   BIP2537I: Node 'Flow.Compute': Executing statement   "
+                   f"''{stmt}'' at ('{func}', '{n + 1}.{rng.randint(1, 9)}'). ")
+        extra = int(noise_per_hit) + (rng.random() < noise_per_hit % 1)
+        for _ in range(extra):
+            yield f"{stamp}   {thread}   UserTrace   {rng.choice(NOISE_LINES)}"
+            if rng.random() < 0.3:
+                yield f"                                       continuation of record {h}"
+
+
+def write_lines(path: Path, lines: Iterable[str]) -> Tuple[int, int]:
+    """Stream lines to a file; returns (line count, byte size)."""
+    count = 0
+    with path.open("w", encoding="utf-8", newline="\n") as f:
+        for line in lines:
+            f.write(line + "\n")
+            count += 1
+    return count, path.stat().st_size
+
+
+# -----------------------------
+# Measurement
+# -----------------------------
+
+def run_phases(esql: Path, trace: Path, report: Path, workers: int) -> Tuple[Dict[str, float], int]:
+    """Seconds per evaluator phase for one run (as --stats reports them), and the number of functions it evaluated."""
+    evaluator = ESQLCoverageEvaluator(
+        trace_log=trace,
+        esql_source=esql,
+        report_file=report,
+        pattern_file=HERE / "tracelog.pattern",
+        filter_modules_file=report.with_name("no-filter-modules.txt"),
+        filter_funcs_file=report.with_name("no-filter-funcs.txt"),
+        workers=workers,
+        collect_stats=True,
+    )
+    evaluator.run()
+    phases = evaluator.stats.phases
+    return {phase: phases[phase]["wall_seconds"] for phase in PHASES}, phases["process"]["functions"]
+
+
+def _measure_child(conn, esql: Path, trace: Path, report: Path, workers: int) -> None:
+    seconds, evaluated = run_phases(esql, trace, report, workers)
+    # The largest of this process and its finished worker processes
+    rss = [kb for kb in peak_rss_kb() if kb is not None]
+    conn.send((seconds, evaluated, max(rss) if rss else None))
+    conn.close()
+
+
+def measure(esql: Path, trace: Path, report: Path, workers: int) -> Tuple[Dict[str, float], int, int | None]:
+    """run_phases in a fresh process, so its peak RSS is the evaluator's and not the generator's."""
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_measure_child, args=(child, esql, trace, report, workers))
+    process.start()
+    child.close()
+    try:
+        seconds, evaluated, rss = parent.recv()
+    except EOFError:
+        raise RuntimeError("benchmark run failed (see the error above)") from None
+    finally:
+        process.join()
+    return seconds, evaluated, rss
+
+
+def benchmark(args: argparse.Namespace, workdir: Path) -> dict:
+    rng = random.Random(args.seed)
+    src, functions = generate_esql(rng, args.schemas, args.modules, args.procedures, args.depth)
+    esql = workdir / "bench.esql"
+    trace = workdir / "bench.trace.txt"
+    _, source_bytes = write_lines(esql, src)
+    trace_lines, trace_bytes = write_lines(trace, generate_trace(rng, functions, args.hits, args.noise, args.style))
+
+    # Best of --repeat runs per phase; the first run also warms the OS file cache
+    best: Dict[str, float] = {}
+    peak_rss: int | None = None
+    for _ in range(args.repeat):
+        seconds_by_phase, evaluated, rss = measure(esql, trace, workdir / "bench_report.txt", args.workers)
+        for phase, seconds in seconds_by_phase.items():
+            best[phase] = min(seconds, best.get(phase, seconds))
+        if rss is not None:
+            peak_rss = max(rss, peak_rss or 0)
+
+    sizes = {"discover": (len(src), source_bytes), "extract": (trace_lines, trace_bytes),
+             "process": (len(src), source_bytes), "report": (len(src), source_bytes)}
+    phases = {}
+    for phase in PHASES:
+        lines, size = sizes[phase]
+        seconds = best[phase]
+        phases[phase] = {
+            "seconds": round(seconds, 6),
+            "lines_per_second": round(lines / seconds) if seconds else None,
+            "mb_per_second": round(size / (1 << 20) / seconds, 3) if seconds else None,
+        }
+    return {
+        "scenario": {name: getattr(args, name) for name in
+                     ("seed", "schemas", "modules", "procedures", "depth", "hits", "noise", "style", "workers")},
+        "input": {"functions": len(functions), "evaluated_functions": evaluated, "source_lines": len(src), "source_bytes": source_bytes,
+                  "trace_lines": trace_lines, "trace_bytes": trace_bytes},
+        "phases": phases,
+        "total_seconds": round(sum(best.values()), 6),
+        "peak_rss_kb": peak_rss,
+    }
+
+
+def print_result(result: dict) -> None:
+    inp = result["input"]
+    print(f"Source : {inp['functions']} functions ({inp['evaluated_functions']} evaluated), "
+          f"{inp['source_lines']} lines, {inp['source_bytes'] >> 10} KB")
+    if inp["evaluated_functions"] != inp["functions"]:
+        print("Warning: not every generated function was evaluated; the process phase covers less than the source")
+    print(f"Trace  : {inp['trace_lines']} lines, {inp['trace_bytes'] >> 10} KB")
+    print(f"{'phase':<10}{'seconds':>10}{'lines/s':>14}{'MB/s':>10}")
+    for phase, m in result["phases"].items():
+        print(f"{phase:<10}{m['seconds']:>10.3f}{m['lines_per_second'] or 0:>14,}{m['mb_per_second'] or 0:>10.2f}")
+    print(f"{'total':<10}{result['total_seconds']:>10.3f}")
+    if result["peak_rss_kb"] is not None:
+        print(f"Peak RSS : {result['peak_rss_kb'] / 1024:.1f} MB")
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> bool:
+    """Print the change against a saved baseline; returns False if a phase got slower than tolerance allows."""
+    if baseline.get("scenario") != result["scenario"]:
+        print("Warning: baseline was recorded with a different scenario")
+    ok = True
+    print(f"\n{'phase':<10}{'baseline':>10}{'current':>10}{'change':>10}")
+    rows = [(phase, baseline["phases"].get(phase, {}).get("seconds"), m["seconds"])
+            for phase, m in result["phases"].items()]
+    rows.append(("total", baseline.get("total_seconds"), result["total_seconds"]))
+    for phase, before, after in rows:
+        if not before:
+            print(f"{phase:<10}{'-':>10}{after:>10.3f}")
+            continue
+        change = (after - before) / before * 100
+        slower = change > tolerance
+        ok = ok and not slower
+        print(f"{phase:<10}{before:>10.3f}{after:>10.3f}{change:>+9.1f}%{'  SLOWER' if slower else ''}")
+    if result["peak_rss_kb"] and baseline.get("peak_rss_kb"):
+        change = (result["peak_rss_kb"] - baseline["peak_rss_kb"]) / baseline["peak_rss_kb"] * 100
+        print(f"Peak RSS : {baseline['peak_rss_kb'] / 1024:.1f} MB -> {result['peak_rss_kb'] / 1024:.1f} MB ({change:+.1f}%)")
+    return ok
+
+
+# -----------------------------
+# CLI
+# -----------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ESQL coverage evaluator on generated sources and traces.")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed; the same seed generates the same inputs")
+    parser.add_argument("--schemas", type=int, default=2, help="Schemas in the generated source")
+    parser.add_argument("--modules", type=int, default=10, help="Compute modules per schema")
+    parser.add_argument("--procedures", type=int, default=8, help="Functions/procedures per module")
+    parser.add_argument("--depth", type=int, default=4, help="Maximum nesting of IF/CASE/LOOP/... blocks")
+    parser.add_argument("--hits", type=int, default=200000, help="Statement records in the generated trace")
+    parser.add_argument("--noise", type=float, default=0.5, help="Share of trace lines that are not statement records (0..1)")
+    parser.add_argument("--style", choices=TRACE_STYLES, default="user", help="UserTrace, ServiceTrace or mixed statement records")
+    parser.add_argument("--workers", type=int, default=1, help="Evaluator worker processes (default: 1, for stable numbers)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per phase; the fastest is reported")
+    parser.add_argument("--workdir", type=Path, default=None, help="Keep the generated inputs and report here (default: a temporary directory)")
+    parser.add_argument("--json", type=Path, default=None, help="Write the results as JSON")
+    parser.add_argument("--save-baseline", type=Path, default=None, help="Write the results as a baseline for --compare")
+    parser.add_argument("--compare", type=Path, default=None, help="Compare with a baseline saved by --save-baseline")
+    parser.add_argument("--tolerance", type=float, default=10.0, help="Percent a phase may be slower than the baseline (default: 10)")
+
+    args = parser.parse_args()
+    if not 0 <= args.noise < 1:
+        parser.error("--noise must be at least 0 and below 1")
+
+    if args.workdir is not None:
+        args.workdir.mkdir(parents=True, exist_ok=True)
+        result = benchmark(args, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory(prefix="esql-bench-") as tmp:
+            result = benchmark(args, Path(tmp))
+    print_result(result)
+
+    for out in (args.json, args.save_baseline):
+        if out is not None:
+            out.write_text(json.dumps(result, indent=2) + "\n", encoding="utf-8")
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text(encoding="utf-8"))
+        if not compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,62 @@
 from __future__ import annotations
 import argparse
+import cProfile
+import bz2
+import glob
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import mmap
+import os
+import pickle
 import re
+import signal
+import socketserver
+import sys
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import chain, repeat
 from pathlib import Path
-from typing import List, Tuple, Dict, Set
+from urllib.parse import parse_qs, urlsplit
+from typing import Callable, ContextManager, Iterator, List, NamedTuple, Sequence, Tuple, Dict, Set
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+# Read buffer used when streaming trace files (traces can be several GB)
+TRACE_READ_BUFFER_SIZE = 1 << 20
+# Traces larger than this are split into byte ranges parsed by separate workers
+DEFAULT_TRACE_SHARD_SIZE = 256 << 20
+# Function batches per --jobs process (see _evaluate_functions_parallel)
+FUNCTION_BATCHES_PER_JOB = 4
+# Write buffer of the streamed text report and SonarQube XML
+REPORT_WRITE_BUFFER_SIZE = 1 << 16
+
+# Literal every standard statement/expression trace message (BIP2537I-BIP2540I) carries
+# before "('<func>', '<line>')."; the fast parser skips lines without it
+FAST_PARSER_MARKER = " at ("
+TRACE_PARSERS = ("regex", "fast")
+RE_FUNCTION_NAME = re.compile(r"[.\w]+")
+# Trace functions that are never mapped to ESQL source
+IGNORED_TRACE_FUNCTIONS = (".statusACTIVE", ".statusINACTIVE")
+# Source files picked up when the ESQL source argument is a directory (project mode)
+ESQL_SOURCE_SUFFIXES = (".esql", ".cmf")
 
 # -----------------------------
 # Helpers
@@ -12,44 +66,1462 @@ def read_text_lines(path: Path) -> List[str]:
     return path.read_text(encoding="utf-8", errors="ignore").splitlines(keepends=False)
 
 
+# Leading bytes of compressed traces -> opener decoding them as a stream
+TRACE_COMPRESSION_MAGIC = (
+    (b"\x1f\x8b", gzip.open),
+    (b"BZh", bz2.open),
+    (b"\xfd7zXZ\x00", lzma.open),
+)
+
+
+def compressed_trace_opener(path: Path):
+    """gzip/bz2/lzma open function if the file starts with their magic bytes, else None."""
+    with open(path, "rb") as f:
+        head = f.read(6)
+    for magic, opener in TRACE_COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return opener
+    return None
+
+
+def iter_text_lines(path: Path, buffer_size: int = TRACE_READ_BUFFER_SIZE) -> Iterator[str]:
+    """Yield the lines of a text file one at a time without loading the whole file.
+
+    gzip, bz2 and xz files are decompressed on the fly. Line splitting matches
+    read_text_lines(), so both produce the same sequence.
+    """
+    opener = compressed_trace_opener(path)
+    if opener is not None:
+        f = opener(path, "rt", encoding="utf-8", errors="ignore", newline="")
+    else:
+        f = open(path, "r", encoding="utf-8", errors="ignore", newline="", buffering=buffer_size)
+    with f:
+        for raw in f:
+            # splitlines() also breaks on separators other than \n/\r (e.g. \x0c, \u2028)
+            parts = raw.splitlines()
+            if parts:
+                yield from parts
+            else:
+                yield ""
+
+
+def iter_text_lines_in_range(path: Path, start: int, end: int,
+                             block_size: int = 8 * TRACE_READ_BUFFER_SIZE) -> Iterator[str]:
+    """Yield the lines of the byte range [start, end) of a file through mmap.
+
+    start and end must be line boundaries (see plan_trace_shards); the lines are the
+    same as iter_text_lines() yields for that part of the file.
+    """
+    return iter_text_lines_in_ranges(path, [(start, end)], block_size)
+
+
+def iter_text_lines_in_ranges(path: Path, ranges: Sequence[Tuple[int, int]],
+                              block_size: int = 8 * TRACE_READ_BUFFER_SIZE) -> Iterator[str]:
+    """iter_text_lines_in_range() for several byte ranges (e.g. a trace slice), mapping the file once."""
+    ranges = [(start, end) for start, end in ranges if end > start]
+    if not ranges:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start, end in ranges:
+            pos = start
+            while pos < end:
+                stop = min(pos + block_size, end)
+                if stop < end:
+                    # Decode whole lines only; UTF-8 sequences never contain b"\n"
+                    nl = mm.rfind(b"\n", pos, stop)
+                    if nl < 0:
+                        nl = mm.find(b"\n", stop, end)
+                    stop = end if nl < 0 else nl + 1
+                yield from mm[pos:stop].decode("utf-8", errors="ignore").splitlines()
+                pos = stop
+
+
+def plan_trace_shards(path: Path, shard_size: int, start: int = 0,
+                      end: int | None = None) -> List[Tuple[int, int]]:
+    """Split a trace file (or its byte range [start, end)) into ranges of about shard_size bytes.
+
+    Every range starts at the beginning of a trace record: the indented continuation
+    lines of a multi-line record (e.g. exception texts) stay with their first line.
+    """
+    size = path.stat().st_size if end is None else end
+    if shard_size <= 0 or size - start <= shard_size:
+        return [(start, size)]
+    bounds = [start]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        target = start + shard_size
+        while target < size:
+            nl = mm.find(b"\n", max(target - 1, bounds[-1]))
+            while 0 <= nl < size - 1 and mm[nl + 1:nl + 2] in (b" ", b"\t"):
+                nl = mm.find(b"\n", nl + 1)
+            if nl < 0 or nl + 1 >= size:
+                break
+            bounds.append(nl + 1)
+            target = nl + 1 + shard_size
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def complete_lines_end(path: Path, start: int = 0) -> int:
+    """Offset just past the last line break at or after start; a line still being written is left out."""
+    with open(path, "rb") as f:
+        pos = os.fstat(f.fileno()).st_size
+        while pos > start:
+            chunk_start = max(start, pos - TRACE_READ_BUFFER_SIZE)
+            f.seek(chunk_start)
+            nl = f.read(pos - chunk_start).rfind(b"\n")
+            if nl >= 0:
+                return chunk_start + nl + 1
+            pos = chunk_start
+    return start
+
+
 def remove_duplicates_and_sort(nums: List[int]) -> List[int]:
     return sorted(set(int(n) for n in nums))
 
 
+# -----------------------------
+# Trace parsing
+# -----------------------------
+
+class TraceLineParser:
+    """Extracts (function, relative_line, statement) from trace lines; picklable for worker processes."""
+
+    def __init__(self, pattern: re.Pattern, mode: str = "regex"):
+        if mode not in TRACE_PARSERS:
+            raise ValueError(f"Unknown trace parser '{mode}', expected one of {', '.join(TRACE_PARSERS)}")
+        self.pattern = pattern
+        self.mode = mode
+        self.parse = self.parse_fast if mode == "fast" else self.parse_regex
+
+    def __getstate__(self):
+        return {"pattern": self.pattern, "mode": self.mode}
+
+    def __setstate__(self, state):
+        self.__init__(state["pattern"], state["mode"])
+
+    def parse_regex(self, line: str) -> Tuple[str, int, str] | None:
+        """Extract (function, relative_line, statement) with the tracelog.pattern regex."""
+        m = self.pattern.search(line)
+        if not m:
+            return None
+        # Prefer named groups if present
+        gd = m.groupdict()
+        function = (gd.get('func') or (m.group(1) if m.lastindex and m.lastindex >= 1 else '') or '').strip()
+        relative_line = (gd.get('line') or (m.group(2) if m.lastindex and m.lastindex >= 2 else '') or '').strip()
+        if not function or not relative_line:
+            return None
+        try:
+            rel = int(float(relative_line))
+        except Exception:
+            return None
+        return function, rel, self._statement_text(line)
+
+    def parse_fast(self, line: str) -> Tuple[str, int, str] | None:
+        """Hand-written parser for the standard "Executing statement ... at (<func>, <line>)." lines.
+
+        Lines without FAST_PARSER_MARKER are skipped without running any regex; lines that
+        have it but do not follow the standard layout go to parse_regex().
+        """
+        at_idx = line.rfind(FAST_PARSER_MARKER)
+        if at_idx < 0:
+            return None
+        if line.startswith("&", at_idx + 5) and line.find(FAST_PARSER_MARKER) == at_idx:
+            # ServiceTrace message template "Executing statement at (&1, &2)": inserts follow later
+            return None
+        close = line.find(")", at_idx)
+        if close < 0 or not line.startswith(").", close):
+            return self.parse_regex(line)
+        function, sep, relative_line = line[at_idx + 5:close].partition(",")
+        function = function.strip().strip("'")
+        relative_line = relative_line.strip().strip("'")
+        whole, dot, fraction = relative_line.partition(".")
+        if (not sep or not RE_FUNCTION_NAME.fullmatch(function)
+                or not (whole.isascii() and whole.isdigit())
+                or (dot and not (fraction.isascii() and fraction.isdigit()))):
+            return self.parse_regex(line)
+        if line.find(" at ", at_idx + 1) >= 0:
+            return function, int(whole), self._statement_text(line)
+        # Statement between the first and last quotes before ' at '
+        last_q = line.rfind("'", 0, at_idx)
+        first_q = line.find("'", 0, last_q)
+        stmt = line[first_q + 1:last_q].strip() if 0 <= first_q < last_q else ""
+        return function, int(whole), stmt
+
+    @staticmethod
+    def _statement_text(line: str) -> str:
+        # Extract statement between the first and last quotes before ' at '
+        stmt = ""
+        try:
+            at_idx = line.rfind(" at ")
+            # Find last single quote before ' at '
+            last_q = line.rfind("'", 0, at_idx)
+            # Find first single quote before that
+            first_q = line.find("'", 0, last_q)
+            if first_q != -1 and last_q != -1 and last_q > first_q:
+                stmt = line[first_q + 1:last_q]
+        except ValueError:
+            stmt = ""
+        return stmt.strip()
+
+
+def scan_trace(trace_log: Path, line_parser: TraceLineParser,
+               known_schema_modules: Set[str] | frozenset | None,
+               byte_range: Tuple[int, int] | List[Tuple[int, int]] | None = None,
+               time_window: Tuple[str, str] | None = None) -> Tuple[Dict[Tuple[str, int, str], int], Dict[str, int]]:
+    """Stream one trace file (or byte ranges of it) and count hits per (function, relative_line, statement).
+
+    Only functions of a known schema/module are kept (all of them if known_schema_modules
+    is None). Also returns line counters; module-level so it can run in a worker process.
+    byte_range may also be a list of ranges (a trace slice); time_window keeps only the
+    records with since <= timestamp < until.
+    """
+    hits: Dict[Tuple[str, int, str], int] = {}
+    parse = line_parser.parse
+    if byte_range is None:
+        lines = iter_text_lines(trace_log)
+    elif isinstance(byte_range, list):
+        lines = iter_text_lines_in_ranges(trace_log, byte_range)
+    else:
+        lines = iter_text_lines_in_range(trace_log, *byte_range)
+    if time_window is not None:
+        lines = filter_time_window(lines, *time_window)
+    line_count = matched = filtered = 0
+    for line_count, line in enumerate(lines, 1):
+        hit = parse(line)
+        if hit is None:
+            continue
+        matched += 1
+        count = hits.get(hit)
+        if count is not None:
+            # Already passed the filter; the parsed strings are dropped again
+            hits[hit] = count + 1
+            continue
+        function = hit[0]
+        schema_and_module = function.rsplit(".", 1)[0] if "." in function else ""
+        if function not in IGNORED_TRACE_FUNCTIONS and (known_schema_modules is None
+                                                        or schema_and_module in known_schema_modules):
+            # One function name object shared by all statements of that function
+            hits[(sys.intern(function), hit[1], hit[2])] = 1
+        else:
+            filtered += 1
+    return hits, {"trace_lines": line_count, "matched_lines": matched, "filtered_lines": filtered}
+
+
+def natural_sort_key(path: Path) -> List[str | int]:
+    """'trace.2.txt' before 'trace.10.txt'."""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", str(path))]
+
+
+def expand_trace_paths(specs: List[str], kind: str = "trace") -> List[Path]:
+    """Expand trace file arguments; glob patterns (e.g. 'integration_server.trace.*.txt') are sorted.
+
+    The files matching a trace pattern are put in time order (see sort_traces_by_time),
+    other files by name with numbers compared by value.
+    """
+    paths: List[Path] = []
+    for spec in specs:
+        if glob.has_magic(spec):
+            matches = sorted((Path(m) for m in glob.glob(spec)), key=natural_sort_key)
+            if not matches:
+                raise FileNotFoundError(f"No {kind} files match: {spec}")
+            paths.extend(sort_traces_by_time(matches) if kind == "trace" else matches)
+        else:
+            paths.append(Path(spec))
+    # Drop duplicates (a file named twice would be counted twice)
+    return list(dict.fromkeys(paths))
+
+
+def find_esql_sources(directory: Path) -> List[Path]:
+    """All ESQL/CMF files below directory, sorted so project reports are reproducible."""
+    return sorted(p for p in directory.rglob("*")
+                  if p.suffix.lower() in ESQL_SOURCE_SUFFIXES and p.is_file())
+
+
+# -----------------------------
+# Trace index (--thread, --message, --message-node, --since/--until)
+# -----------------------------
+
+# Record start: "<date> <time>  <thread id>  ..."
+RE_TRACE_RECORD = re.compile(rb"(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?)\s+(\d+)\s")
+# Messages that mark the start of a new message on their thread
+MESSAGE_START_MARKERS = (b"BIP2632I",)
+RE_INPUT_NODE = re.compile(rb"input node '([^']*)'")
+TRACE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+RE_RECORD_TIME = re.compile(r"(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)(?:\.(\d+))?")
+_EPOCH = datetime(1970, 1, 1)
+
+
+def parse_trace_time(text: str) -> datetime:
+    """Trace or command line timestamp ('2008-04-23 14:22:25.465604', '2008-04-23 14:22', ...).
+
+    The fraction is padded or cut to 6 digits as in TRACE_TIME_FORMAT, as fromisoformat only
+    takes 3 or 6 digits before Python 3.11.
+    """
+    text = text.strip()
+    base, dot, fraction = text.partition(".")
+    if dot and fraction.isdigit():
+        text = f"{base}.{fraction[:6]:0<6}"
+    return datetime.fromisoformat(text)
+
+
+def trace_seconds(text: str) -> float:
+    # Fractions of any length, at full precision
+    base, _, fraction = text.partition(".")
+    return (parse_trace_time(base) - _EPOCH).total_seconds() + (float("0." + fraction) if fraction else 0.0)
+
+
+def first_trace_time(path: Path, max_lines: int = 1000) -> float | None:
+    """trace_seconds of the first record of a trace, None if its first lines have none."""
+    for n, line in enumerate(iter_text_lines(path)):
+        m = RE_TRACE_RECORD.match(line.encode("utf-8"))
+        if m:
+            return trace_seconds(m.group(1).decode("ascii"))
+        if n >= max_lines:
+            break
+    return None
+
+
+def sort_traces_by_time(paths: Sequence[Path]) -> List[Path]:
+    """Traces ordered by their first record, e.g. rotated files, whose names do not sort in time order.
+
+    Files without a timestamp keep their order after the others. Test markers and message
+    numbers carry over from one file to the next, so they need the traces in time order.
+    """
+    stamps = {path: first_trace_time(path) for path in paths}
+    return sorted(paths, key=lambda path: (stamps[path] is None, stamps[path] or 0.0))
+
+
+def record_time(line: str) -> str | None:
+    """Timestamp of a trace record in TRACE_TIME_FORMAT (fraction padded or cut to 6 digits), None for other lines.
+
+    The result compares as a string with other TRACE_TIME_FORMAT timestamps.
+    """
+    m = RE_RECORD_TIME.match(line)
+    if m is None:
+        return None
+    return f"{m.group(1)}.{(m.group(2) or '')[:6]:0<6}"
+
+
+def filter_time_window(lines: Iterator[str], since: str, until: str) -> Iterator[str]:
+    """Keep the records stamped since <= t < until (TRACE_TIME_FORMAT strings) and their continuation lines."""
+    keep = False
+    for line in lines:
+        if line[:4].isdigit():
+            stamp = record_time(line)
+            keep = stamp is not None and since <= stamp < until
+        elif line[:1] not in (" ", "\t"):
+            keep = False
+        if keep:
+            yield line
+
+
+class TraceSlice(NamedTuple):
+    """Part of the traces to evaluate; an empty selection does not restrict."""
+    threads: frozenset = frozenset()  # thread ids as printed in the trace
+    messages: frozenset = frozenset()  # message numbers as listed by --list-messages (from 1)
+    nodes: frozenset = frozenset()  # input nodes that received the message (message types)
+    since: str | None = None
+    until: str | None = None
+
+    def time_window(self) -> Tuple[str, str] | None:
+        if self.since is None and self.until is None:
+            return None
+        since = parse_trace_time(self.since).strftime(TRACE_TIME_FORMAT) if self.since else ""
+        until = parse_trace_time(self.until).strftime(TRACE_TIME_FORMAT) if self.until else "\uffff"
+        return since, until
+
+
+class TraceIndex:
+    """Byte offsets of the thread segments and message boundaries of one plain-text trace.
+
+    A segment is a run of records of one thread (with their continuation lines) within one
+    message; a message starts at a MESSAGE_START_MARKERS record and spans all later segments
+    of its thread up to the next one. The index is built in one pass and extended when the
+    trace grows, so slices are read without scanning the whole trace again.
+    """
+
+    def __init__(self):
+        self.end = 0  # offset up to which the trace is indexed (a line boundary)
+        self.fingerprint = b""
+        self.threads: List[str] = []
+        self.nodes: List[str] = []
+        self.segment_starts = array("Q")
+        self.segment_threads = array("I")
+        self.segment_messages = array("i")  # message (0-based), -1 before the first one of the thread
+        self.segment_first = array("d")  # seconds of the first/last record; NaN without timestamps
+        self.segment_last = array("d")
+        self.message_threads = array("I")
+        self.message_nodes = array("I")
+        self.message_times: List[str] = []
+        # Scan state, so that update() can continue where it stopped
+        self._thread_ids: Dict[str, int] = {}
+        self._node_ids: Dict[str, int] = {}
+        self._thread_messages: Dict[int, int] = {}
+
+    @classmethod
+    def load(cls, path: Path) -> "TraceIndex":
+        try:
+            with open(path, "rb") as f:
+                index = pickle.load(f)
+        except Exception:
+            # Missing, truncated or of another tool version: build it again
+            return cls()
+        return index if isinstance(index, cls) and index.__dict__.keys() == cls().__dict__.keys() else cls()
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def update(self, trace_log: Path) -> None:
+        """Index the lines added since the last update; starts over if the trace was replaced.
+
+        The trace is indexed to its end, including a last line without a line break; text
+        appended to that line later extends the segment it belongs to.
+        """
+        if compressed_trace_opener(trace_log) is not None:
+            raise ValueError(f"Compressed traces cannot be sliced: {trace_log}")
+        size = trace_log.stat().st_size
+        if self.end and (size < self.end or trace_fingerprint(
+                trace_log, min(self.end, TRACE_FINGERPRINT_SIZE)) != self.fingerprint):
+            self.__init__()
+        end = size
+        if end <= self.end:
+            return
+        nan = float("nan")
+        thread = self.segment_threads[-1] if self.segment_starts else -1
+        last = self.segment_last[-1] if self.segment_starts else nan
+        pos = self.end
+        with open(trace_log, "rb", buffering=TRACE_READ_BUFFER_SIZE) as f:
+            f.seek(pos)
+            for raw in f:
+                if pos >= end:
+                    break
+                start = pos
+                pos += len(raw)
+                m = RE_TRACE_RECORD.match(raw)
+                if m is None:
+                    # Continuation line, or a header before the first record
+                    if not self.segment_starts:
+                        self._open_segment(start, self._thread_id(""), nan)
+                        thread = self.segment_threads[-1]
+                    continue
+                record_time = raw[:m.end(1)].decode("ascii")
+                seconds = trace_seconds(record_time)
+                record_thread = self._thread_id(m.group(2).decode("ascii"))
+                message_start = any(marker in raw for marker in MESSAGE_START_MARKERS)
+                if message_start:
+                    node = RE_INPUT_NODE.search(raw)
+                    node_name = node.group(1).decode("utf-8", errors="ignore") if node else ""
+                    node_id = self._node_ids.get(node_name)
+                    if node_id is None:
+                        node_id = self._node_ids[node_name] = len(self.nodes)
+                        self.nodes.append(node_name)
+                    self._thread_messages[record_thread] = len(self.message_threads)
+                    self.message_threads.append(record_thread)
+                    self.message_nodes.append(node_id)
+                    self.message_times.append(record_time)
+                if record_thread != thread or message_start:
+                    if self.segment_starts:
+                        self.segment_last[-1] = last
+                    self._open_segment(start, record_thread, seconds)
+                    thread = record_thread
+                last = seconds
+        if self.segment_starts:
+            self.segment_last[-1] = last
+        self.end = end
+        self.fingerprint = trace_fingerprint(trace_log, min(end, TRACE_FINGERPRINT_SIZE))
+
+    def _thread_id(self, name: str) -> int:
+        thread_id = self._thread_ids.get(name)
+        if thread_id is None:
+            thread_id = self._thread_ids[name] = len(self.threads)
+            self.threads.append(name)
+        return thread_id
+
+    def _open_segment(self, start: int, thread: int, seconds: float) -> None:
+        self.segment_starts.append(start)
+        self.segment_threads.append(thread)
+        self.segment_messages.append(self._thread_messages.get(thread, -1))
+        self.segment_first.append(seconds)
+        self.segment_last.append(seconds)
+
+    def byte_ranges(self, threads: Set[str] | frozenset = frozenset(), messages: Set[int] | frozenset = frozenset(),
+                    since: float | None = None, until: float | None = None) -> List[Tuple[int, int]]:
+        """Byte ranges of the segments of the given threads/messages (0-based) that overlap [since, until).
+
+        Adjacent segments are joined; records of a boundary segment outside the time window
+        still have to be dropped by filter_time_window().
+        """
+        thread_ids = {self._thread_ids[t] for t in threads if t in self._thread_ids} if threads else None
+        timed = since is not None or until is not None
+        since = float("-inf") if since is None else since
+        until = float("inf") if until is None else until
+        ranges: List[Tuple[int, int]] = []
+        starts = self.segment_starts
+        count = len(starts)
+        for i in range(count):
+            if thread_ids is not None and self.segment_threads[i] not in thread_ids:
+                continue
+            if messages and self.segment_messages[i] not in messages:
+                continue
+            # NaN (no timestamp) fails both comparisons
+            if timed and not (self.segment_last[i] >= since and self.segment_first[i] < until):
+                continue
+            start, end = starts[i], starts[i + 1] if i + 1 < count else self.end
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def messages_of_nodes(self, nodes: Set[str] | frozenset) -> Set[int]:
+        node_ids = {self._node_ids[n] for n in nodes if n in self._node_ids}
+        return {i for i, node in enumerate(self.message_nodes) if node in node_ids}
+
+
+def trace_index_path(index_dir: Path, trace_log: Path) -> Path:
+    """Index file of a trace: named after its resolved path, so equally named traces do not collide."""
+    digest = hashlib.sha1(str(trace_log.resolve()).encode("utf-8")).hexdigest()[:16]
+    return index_dir / f"{trace_log.name}.{digest}.idx"
+
+
+# -----------------------------
+# Incremental coverage store
+# -----------------------------
+
+# Leading bytes of a trace kept with its checkpoint, to notice a reused inode
+TRACE_FINGERPRINT_SIZE = 256
+
+
+def trace_fingerprint(path: Path, size: int = TRACE_FINGERPRINT_SIZE) -> bytes:
+    with open(path, "rb") as f:
+        return f.read(size)
+
+
+class CoverageStore:
+    """SQLite file with the accumulated trace hits and, per trace file, how far it was read.
+
+    Checkpoints are keyed by device and inode, so a rotated (renamed) trace resumes where
+    it was left. Hits are stored unfiltered; the known schemas/modules are applied on load.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS hits (
+            function TEXT NOT NULL, line INTEGER NOT NULL, statement TEXT NOT NULL,
+            count INTEGER NOT NULL, PRIMARY KEY (function, line, statement));
+        CREATE TABLE IF NOT EXISTS trace_checkpoints (
+            device INTEGER NOT NULL, inode INTEGER NOT NULL, path TEXT NOT NULL,
+            offset INTEGER NOT NULL, fingerprint BLOB NOT NULL, PRIMARY KEY (device, inode));
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(str(path))
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> "CoverageStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def reset_if_changed(self, trace_pattern: str) -> None:
+        """Drop hits and checkpoints recorded with a different tracelog.pattern."""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'pattern'").fetchone()
+        if row is not None and row[0] == trace_pattern:
+            return
+        with self.conn:
+            self.conn.execute("DELETE FROM hits")
+            self.conn.execute("DELETE FROM trace_checkpoints")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pattern', ?)", (trace_pattern,))
+
+    def resume_offset(self, trace_log: Path) -> int:
+        """Byte offset up to which trace_log was already read (0 for a new or rewritten file)."""
+        st = trace_log.stat()
+        row = self.conn.execute("SELECT offset, fingerprint FROM trace_checkpoints WHERE device = ? AND inode = ?",
+                                (st.st_dev, st.st_ino)).fetchone()
+        if row is None:
+            return 0
+        offset, fingerprint = row
+        # Truncated, or the inode now belongs to another file
+        if offset > st.st_size or trace_fingerprint(trace_log, min(offset, TRACE_FINGERPRINT_SIZE)) != fingerprint:
+            return 0
+        return offset
+
+    def record(self, hits: Dict[Tuple[str, int, str], int], checkpoints: List[Tuple[Path, int]]) -> None:
+        """Add hits and move the checkpoints in one transaction."""
+        with self.conn:
+            # INSERT OR IGNORE + UPDATE rather than an upsert, which needs SQLite 3.24+
+            self.conn.executemany("INSERT OR IGNORE INTO hits (function, line, statement, count) VALUES (?, ?, ?, 0)",
+                                  list(hits))
+            self.conn.executemany("UPDATE hits SET count = count + ? WHERE function = ? AND line = ? AND statement = ?",
+                                  ((count, func, rel, stmt) for (func, rel, stmt), count in hits.items()))
+            for trace_log, offset in checkpoints:
+                st = trace_log.stat()
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO trace_checkpoints (device, inode, path, offset, fingerprint) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (st.st_dev, st.st_ino, str(trace_log), offset,
+                     trace_fingerprint(trace_log, min(offset, TRACE_FINGERPRINT_SIZE))))
+
+    def load_hits(self) -> Iterator[Tuple[Tuple[str, int, str], int]]:
+        for func, rel, stmt, count in self.conn.execute("SELECT function, line, statement, count FROM hits"):
+            yield (func, rel, stmt), count
+
+
+# -----------------------------
+# Parsed source model cache
+# -----------------------------
+
+DEFAULT_SOURCE_CACHE_SIZE = 256 << 20
+
+
+@lru_cache(maxsize=None)
+def tool_fingerprint() -> str:
+    """Hash of this module; cached source models of another tool version are never used."""
+    return hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+
+
+class SourceModelCache:
+    """Directory of pickled SourceModel files named after their key, evicted least recently used first."""
+
+    SUFFIX = ".model"
+
+    def __init__(self, directory: Path, max_bytes: int = DEFAULT_SOURCE_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(source: bytes, *parts: str) -> str:
+        """Key of a source file's content plus everything else its parsed model depends on."""
+        h = hashlib.sha256(tool_fingerprint().encode())
+        for part in parts:
+            h.update(b"\0" + part.encode("utf-8"))
+        h.update(b"\0" + source)
+        return h.hexdigest()
+
+    def get(self, key: str):
+        path = self.directory / (key + self.SUFFIX)
+        try:
+            with open(path, "rb") as f:
+                model = pickle.load(f)
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Truncated or unreadable entry: parse again and overwrite it
+            return None
+        return model
+
+    def put(self, key: str, model) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / (key + self.SUFFIX)
+        # Write then rename, so concurrent workers never read a partial entry
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def evict(self) -> None:
+        """Delete the least recently used entries until the cache fits in max_bytes."""
+        if not self.directory.is_dir():
+            return
+        entries = []
+        for path in self.directory.glob("*" + self.SUFFIX):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+# -----------------------------
+# Coverage snapshots (--snapshot, merge)
+# -----------------------------
+
+SNAPSHOT_MAGIC = b"IAM2SNAP"
+SNAPSHOT_VERSION = 1
+
+
+def file_digest(path: Path) -> bytes:
+    return hashlib.sha256(path.read_bytes()).digest()
+
+
+def _pack_str(out: bytearray, text: str) -> None:
+    data = text.encode("utf-8")
+    out += struct.pack("<I", len(data))
+    out += data
+
+
+def _unpack_str(data: bytes, pos: int) -> Tuple[str, int]:
+    (size,) = struct.unpack_from("<I", data, pos)
+    pos += 4
+    return data[pos:pos + size].decode("utf-8"), pos + size
+
+
+class CoverageSnapshot:
+    """Executed relative lines and line hit counts per source file and function/procedure.
+
+    Snapshots of separate runs (e.g. CI shards) add up: executed lines are united and hits
+    summed, which gives the same coverage as one run over all their traces. Sources are
+    identified by name (relative path in project mode) and checked by content digest;
+    functions by key and first body line, so module/function filters may differ.
+    The file is a small header followed by zlib-compressed little-endian records.
+    """
+
+    def __init__(self):
+        # source name -> SHA-256 of its content
+        self.digests: Dict[str, bytes] = {}
+        # (source name, body start line, function key) -> (executed relative lines, relative line -> hits)
+        self.functions: Dict[Tuple[str, int, str], Tuple[Set[int], Dict[int, int]]] = {}
+
+    def add_source(self, name: str, digest: bytes, origin: str = "") -> None:
+        known = self.digests.setdefault(name, digest)
+        if known != digest:
+            raise ValueError(f"Snapshot {origin or 'data'} was taken from another version of source '{name}'")
+
+    def add_function(self, name: str, body_start: int, key: str, executed, line_hits: Dict[int, int]) -> None:
+        entry = self.functions.get((name, body_start, key))
+        if entry is None:
+            entry = self.functions[(name, body_start, key)] = (set(), {})
+        entry[0].update(executed)
+        hits = entry[1]
+        for n, count in line_hits.items():
+            hits[n] = hits.get(n, 0) + count
+
+    def load(self, path: Path) -> None:
+        """Add the content of a snapshot file."""
+        with open(path, "rb") as f:
+            header = f.read(len(SNAPSHOT_MAGIC) + 2)
+            if header[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError(f"Not a coverage snapshot: {path}")
+            if len(header) < len(SNAPSHOT_MAGIC) + 2:
+                raise ValueError(f"{path}: corrupt coverage snapshot")
+            (version,) = struct.unpack_from("<H", header, len(SNAPSHOT_MAGIC))
+            if version != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported coverage snapshot version {version}: {path}")
+            payload = f.read()
+        try:
+            self._load_records(zlib.decompress(payload), path)
+        except (zlib.error, struct.error, UnicodeDecodeError):
+            raise ValueError(f"{path}: corrupt coverage snapshot") from None
+
+    def _load_records(self, data: bytes, path: Path) -> None:
+        (source_count,) = struct.unpack_from("<I", data, 0)
+        pos = 4
+        for _ in range(source_count):
+            name, pos = _unpack_str(data, pos)
+            digest = data[pos:pos + 32]
+            (function_count,) = struct.unpack_from("<I", data, pos + 32)
+            pos += 36
+            self.add_source(name, digest, str(path))
+            for _ in range(function_count):
+                key, pos = _unpack_str(data, pos)
+                body_start, executed_count, hit_count = struct.unpack_from("<III", data, pos)
+                pos += 12
+                executed = struct.unpack_from(f"<{executed_count}I", data, pos)
+                pos += 4 * executed_count
+                hit_lines = struct.unpack_from(f"<{hit_count}I", data, pos)
+                pos += 4 * hit_count
+                hit_counts = struct.unpack_from(f"<{hit_count}Q", data, pos)
+                pos += 8 * hit_count
+                self.add_function(name, body_start, key, executed, dict(zip(hit_lines, hit_counts)))
+
+    def write(self, path: Path) -> None:
+        by_source: Dict[str, List[Tuple[int, str]]] = {name: [] for name in self.digests}
+        for name, body_start, key in self.functions:
+            by_source[name].append((body_start, key))
+        out = bytearray(struct.pack("<I", len(by_source)))
+        for name in sorted(by_source):
+            _pack_str(out, name)
+            out += self.digests[name]
+            out += struct.pack("<I", len(by_source[name]))
+            for body_start, key in sorted(by_source[name]):
+                executed, line_hits = self.functions[(name, body_start, key)]
+                hit_lines = sorted(line_hits)
+                _pack_str(out, key)
+                out += struct.pack(f"<III{len(executed)}I", body_start, len(executed), len(hit_lines), *sorted(executed))
+                out += struct.pack(f"<{len(hit_lines)}I", *hit_lines)
+                out += struct.pack(f"<{len(hit_lines)}Q", *(line_hits[n] for n in hit_lines))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so a collector never picks up a partial snapshot
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(SNAPSHOT_MAGIC + struct.pack("<H", SNAPSHOT_VERSION))
+            f.write(zlib.compress(bytes(out), 9))
+        os.replace(tmp, path)
+
+
+# -----------------------------
+# Test impact map (--impact-map, impact)
+# -----------------------------
+
+IMPACT_MAP_VERSION = 1
+
+
+def read_test_windows(path: Path) -> List[Tuple[str, str, str]]:
+    """(test, start, end) per line "<test>\\t<start>\\t<end>" of a test times file, sorted by start.
+
+    Times are normalised to TRACE_TIME_FORMAT; blank lines and '#' comments are skipped.
+    """
+    windows: List[Tuple[str, str, str]] = []
+    for line_no, line in enumerate(read_text_lines(path), 1):
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        parts = line.split("\t")
+        if len(parts) != 3:
+            raise ValueError(f"{path}:{line_no}: expected '<test>\\t<start>\\t<end>'")
+        name, start, end = (part.strip() for part in parts)
+        windows.append((parse_trace_time(start).strftime(TRACE_TIME_FORMAT),
+                        parse_trace_time(end).strftime(TRACE_TIME_FORMAT), name))
+    windows.sort()
+    return [(name, start, end) for start, end, name in windows]
+
+
+def parse_line_spec(spec: str) -> Tuple[str, Set[int]]:
+    """'<source>:10-20,25' -> (source, {10, ..., 20, 25}); file line numbers as shown by git diff."""
+    source, sep, ranges = spec.rpartition(":")
+    if not sep or not source:
+        raise ValueError(f"expected '<source>:<first>-<last>[,...]': {spec}")
+    lines: Set[int] = set()
+    try:
+        for part in ranges.split(","):
+            first, _, last = part.partition("-")
+            lines.update(range(int(first), int(last or first) + 1))
+    except ValueError:
+        raise ValueError(f"expected '<source>:<first>-<last>[,...]': {spec}") from None
+    return source, lines
+
+
+def match_source_name(names: Sequence[str], source: str) -> str | None:
+    """Name of the map/snapshot source a user-given path refers to (exact or as a path suffix)."""
+    source = source.replace("\\", "/")
+    if source in names:
+        return source
+    for name in names:
+        if source.endswith("/" + name) or name.endswith("/" + source):
+            return name
+    return None
+
+
+def find_repo_root(path: Path) -> Path | None:
+    """Nearest directory at or above path with a .git entry: the directory git diff paths are relative to."""
+    for directory in (path, *path.parents):
+        if (directory / ".git").exists():
+            return directory
+    return None
+
+
+def select_tests(impact_map: dict, changed: Dict[str, Set[int]]) -> Tuple[List[str], Dict[str, List[int]]]:
+    """Small set of tests that together cover every changed line any test covers.
+
+    Greedy set cover (always the test covering most of the remaining lines, ties in map
+    order). Also returns, per source, the changed executable lines no test covers.
+    """
+    tests: List[str] = impact_map["tests"]
+    sources: Dict[str, Dict[str, List[int]]] = impact_map["sources"]
+    remaining: Dict[int, Set[Tuple[str, int]]] = {}
+    uncovered: Dict[str, List[int]] = {}
+    for source, lines in changed.items():
+        name = match_source_name(list(sources), source)
+        if name is None:
+            continue
+        line_tests = sources[name]
+        for n in sorted(lines):
+            covering = line_tests.get(str(n))
+            if covering is None:
+                continue  # not an executable line
+            if not covering:
+                uncovered.setdefault(name, []).append(n)
+            for test in covering:
+                remaining.setdefault(test, set()).add((name, n))
+    selected: List[str] = []
+    to_cover = set().union(*remaining.values()) if remaining else set()
+    while to_cover:
+        best = max(remaining, key=lambda t: (len(remaining[t] & to_cover), -t))
+        selected.append(tests[best])
+        to_cover -= remaining.pop(best)
+    return selected, uncovered
+
+
+# -----------------------------
+# Diff-aware evaluation (--results, --diff, --changed)
+# -----------------------------
+
+# '+++ b/path' (git) or '+++ path<TAB>timestamp' (diff -u)
+RE_DIFF_NEW_FILE = re.compile(r"^\+\+\+ (?:b/)?([^\t]+?)\s*(?:\t.*)?$")
+RE_DIFF_HUNK = re.compile(r"^@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+def parse_unified_diff(lines: Iterator[str]) -> Dict[str, Set[int]]:
+    """Added or modified lines (new file line numbers) per file of a unified diff, e.g. of 'git diff'."""
+    changed: Dict[str, Set[int]] = {}
+    current: Set[int] | None = None
+    new_line = 0
+    # Lines of the current hunk still to come; inside a hunk '+++ ' or '--- ' is content
+    old_left = new_left = 0
+    previous = ""
+    for line in lines:
+        if old_left > 0 or new_left > 0:
+            if line.startswith("+"):
+                if current is not None:
+                    current.add(new_line)
+                new_line += 1
+                new_left -= 1
+            elif line.startswith("-"):
+                old_left -= 1
+            elif line.startswith(" ") or not line:
+                new_line += 1
+                old_left -= 1
+                new_left -= 1
+            # '\ No newline at end of file' belongs to no side
+            continue
+        if line.startswith("+++ ") and previous.startswith("--- "):
+            m = RE_DIFF_NEW_FILE.match(line)
+            path = m.group(1) if m else ""
+            current = None if path == "/dev/null" else changed.setdefault(path, set())
+        else:
+            m = RE_DIFF_HUNK.match(line)
+            if m:
+                old_left = int(m.group(1) or 1)
+                new_line = int(m.group(2))
+                new_left = int(m.group(3) or 1)
+        previous = line
+    return {path: lines for path, lines in changed.items() if lines}
+
+
+def function_fingerprint(function: FunctionSource, entries: List[Tuple[Tuple[int, str], int]]) -> bytes:
+    """Digest of a function's body and of its traced (line, statement) -> hits entries."""
+    h = hashlib.sha256()
+    h.update(function.numbers.tobytes())
+    for text in function.text:
+        h.update(text.encode("utf-8") + b"\n")
+    h.update(repr(sorted(entries)).encode("utf-8"))
+    return h.digest()
+
+
+# -----------------------------
+# ESQL lexer
+# -----------------------------
+
+# Next character sequence that changes lexer state outside comments and string literals
+RE_LEX_SPECIAL = re.compile(r"--|/\*|'|\"|&#xd;", re.IGNORECASE)
+
+
+class ESQLLine:
+    """Lexer summary of one ESQL source line.
+
+    code: the line without comments, with string literal contents blanked (quotes kept)
+          and &#xd; CMF artifacts replaced by a space, so keyword matching never hits
+          text inside comments or strings.
+    has_code: the line contains something besides whitespace and comments.
+    has_comment: the line contains (or lies inside) a comment.
+    in_comment: the line starts inside a block comment opened on an earlier line.
+    """
+
+    __slots__ = ("code", "has_code", "has_comment", "in_comment")
+
+    def __init__(self, code: str, has_comment: bool, in_comment: bool):
+        self.code = code
+        self.has_code = bool(code.strip())
+        self.has_comment = has_comment
+        self.in_comment = in_comment
+
+
+def tokenize_esql(lines: List[str]) -> List[ESQLLine]:
+    """Lex ESQL source in one pass, tracking block comments and string literals across lines."""
+    out: List[ESQLLine] = []
+    in_block_comment = False
+    in_string = False
+    for line in lines:
+        parts: List[str] = []
+        starts_in_comment = in_block_comment
+        has_comment = in_block_comment
+        i = 0
+        end = len(line)
+        while i < end:
+            if in_block_comment:
+                j = line.find("*/", i)
+                if j < 0:
+                    break
+                in_block_comment = False
+                parts.append(" ")
+                i = j + 2
+                continue
+            if in_string:
+                j = line.find("'", i)
+                if j < 0:
+                    break
+                if line.startswith("''", j):
+                    # Doubled quote is an escaped quote inside the literal
+                    i = j + 2
+                    continue
+                in_string = False
+                parts.append("'")
+                i = j + 1
+                continue
+            m = RE_LEX_SPECIAL.search(line, i)
+            if not m:
+                parts.append(line[i:])
+                break
+            parts.append(line[i:m.start()])
+            token = m.group()
+            if token == "--":
+                has_comment = True
+                break
+            if token == "/*":
+                has_comment = True
+                in_block_comment = True
+                i = m.end()
+            elif token == "'":
+                parts.append("'")
+                in_string = True
+                i = m.end()
+            elif token == '"':
+                # Quoted identifier: kept verbatim
+                j = line.find('"', m.end())
+                j = end if j < 0 else j + 1
+                parts.append(line[m.start():j])
+                i = j
+            else:
+                parts.append(" ")
+                i = m.end()
+        out.append(ESQLLine("".join(parts), has_comment, starts_in_comment))
+    return out
+
+
+# Statement-level patterns, matched against ESQLLine.code
+RE_NAMED_SCHEMA = re.compile(r"\bCREATE\s+SCHEMA\s+([A-Za-z0-9_.]+)\s+PATH", re.IGNORECASE)
+RE_DEFAULT_SCHEMA = re.compile(r"\bCREATE\s+SCHEMA\s+""\s+PATH", re.IGNORECASE)
+RE_MODULE = re.compile(r"\bCREATE\s+(?:COMPUTE|FILTER|DATABASE)\s+MODULE\s+(.+)$", re.IGNORECASE)
+RE_END_MODULE = re.compile(r"\bEND\s+MODULE;", re.IGNORECASE)
+RE_FUNC_OR_PROC = re.compile(r"\bCREATE\s+(?:FUNCTION|PROCEDURE)\s+(\w+)\s*\(", re.IGNORECASE)
+RE_END_STMT_VARIANTS = re.compile(r"(^|\s)END\s*;\s*$", re.IGNORECASE)
+RE_BEGIN_ATOMIC = re.compile(r"\bBEGIN\s+ATOMIC\b", re.IGNORECASE)
+RE_CASE = re.compile(r"\bCASE\b", re.IGNORECASE)
+RE_END_CASE = re.compile(r"\bEND\s+CASE\s*;", re.IGNORECASE)
+RE_STMT_COMPLETE = re.compile(r";\s*$|\b(THEN|ELSE|BEGIN|DO)\s*$", re.IGNORECASE)
+RE_CONTINUATION_COMPLETE = re.compile(r"\b(THEN|DO|BEGIN)\b$", re.IGNORECASE)
+
+
+def discover_schema_modules(line_info: List[ESQLLine]) -> List[str]:
+    """Schema and schema.module names declared in one source file ("" stands for no schema)."""
+    modules: List[str] = []
+    current_schema = ""
+    for info in line_info:
+        line = info.code.rstrip()
+        if "CREATE" not in line.upper():
+            continue
+        m = RE_NAMED_SCHEMA.search(line)
+        if m:
+            current_schema = m.group(1).strip()
+            modules.append(current_schema)
+            continue
+        if RE_DEFAULT_SCHEMA.search(line):
+            current_schema = ""
+            continue
+        m2 = RE_MODULE.search(line)
+        if m2:
+            esql_module = m2.group(1).strip()
+            modules.append(f"{current_schema}.{esql_module}" if current_schema else f".{esql_module}")
+    modules.append("")
+    return modules
+
+
+# -----------------------------
+# Block structure index (control flow expansion)
+# -----------------------------
+
+# (opener, closer, middle branch) of every control block that is expanded for an executed line
+CONTROL_BLOCKS: Tuple[Tuple[str, str, str], ...] = (
+    ("IF", "END IF", "ELSE"),
+    ("WHILE", "END WHILE", ""),
+    ("LOOP", "END LOOP", ""),
+    ("CASE", "END CASE", "WHEN"),
+    ("REPEAT", "END REPEAT", ""),
+    ("FOR", "END FOR", ""),
+    ("BEGIN ATOMIC", "END", ""),
+)
+
+RE_BEGIN_END_STMT = re.compile(r"^BEGIN\b.*\bEND\b", re.IGNORECASE)
+RE_ATOMIC_STMT = re.compile(r"^(.*)\s*:\s*.*ATOMIC.*END", re.IGNORECASE)
+RE_END_STMT = re.compile(r"^END\s*;", re.IGNORECASE)
+
+# Per block kind, keyed by opener; matched against left-stripped ESQLLine.code
+RE_OPENER = {b: re.compile(rf"^{b}\b", re.IGNORECASE) for b, _, _ in CONTROL_BLOCKS}
+RE_CLOSER = {b: re.compile(rf"^{e}\s*;", re.IGNORECASE) for b, e, _ in CONTROL_BLOCKS}
+RE_MIDDLE = {b: re.compile(rf"^{m}\b", re.IGNORECASE) for b, _, m in CONTROL_BLOCKS if m}
+RE_LABELLED_OPENER = {b: re.compile(rf"^(\w+)\s*:\s*{b}\b", re.IGNORECASE) for b, _, _ in CONTROL_BLOCKS}
+RE_LABELLED_CLOSER = {b: re.compile(rf"^{e}\s+(\w+)\s*;", re.IGNORECASE) for b, e, _ in CONTROL_BLOCKS}
+
+
+class BlockIndex:
+    """Block structure of one function body, built in a single stack-based pass.
+
+    For every opener (unlabelled, or labelled per label) it records the middle branches
+    (ELSE/WHEN) seen directly inside the block and the closer. A start line that is not
+    itself an opener expands to the next opener on the same nesting level, as the
+    original forward scans did.
+    """
+
+    def __init__(self, code: List[str | None]):
+        # code: left-stripped ESQLLine.code per relative line, None for lines without code
+        self.code = code
+        self.line_count = len(code)
+        # (opener, label) -> opener line -> [middle lines..., closer line]
+        self.tails: Dict[Tuple[str, str], Dict[int, List[int]]] = {}
+        # opener -> relative line -> line of the opener a forward scan would lock onto
+        self.next_opener: Dict[str, List[int]] = {}
+        # relative line -> (opener, label) of a labelled opener on that line
+        self.labelled_openers: Dict[int, Tuple[str, str]] = {}
+        # Last "END;" line and last "END <label>;" line per label, filled on demand
+        self._last_end_line: int | None = None
+        self._last_labelled_end_line: Dict[str, int | None] = {}
+        self._build()
+
+    def _build(self) -> None:
+        code: List[str | None] = [None] + self.code
+        for opener, _, _ in CONTROL_BLOCKS:
+            re_opener = RE_OPENER[opener]
+            re_closer = RE_CLOSER[opener]
+            re_middle = RE_MIDDLE.get(opener)
+            re_labelled_opener = RE_LABELLED_OPENER[opener]
+            re_labelled_closer = RE_LABELLED_CLOSER[opener]
+
+            tails: Dict[int, List[int]] = {}
+            stack: List[int] = []
+            labelled_stacks: Dict[str, List[int]] = {}
+            level = 0
+            level_before = [0] * (self.line_count + 1)
+            is_opener = [False] * (self.line_count + 1)
+            for n in range(1, self.line_count + 1):
+                level_before[n] = level
+                content = code[n]
+                if content is None:
+                    continue
+
+                # Labelled blocks: one nesting counter per label
+                opened_label = None
+                lm = re_labelled_opener.match(content)
+                if lm:
+                    opened_label = lm.group(1).lower()
+                    self.labelled_openers[n] = (opener, opened_label)
+                    self.tails.setdefault((opener, opened_label), {})[n] = []
+                    labelled_stacks.setdefault(opened_label, []).append(n)
+                if re_middle is not None and re_middle.search(content):
+                    for label, open_lines in labelled_stacks.items():
+                        if open_lines and label != opened_label:
+                            self.tails[(opener, label)][open_lines[-1]].append(n)
+                else:
+                    lm = re_labelled_closer.match(content)
+                    if lm:
+                        open_lines = labelled_stacks.get(lm.group(1).lower())
+                        if open_lines:
+                            self.tails[(opener, lm.group(1).lower())][open_lines.pop()].append(n)
+
+                # Unlabelled blocks: a closer with no open block still lowers the level
+                if re_opener.search(content):
+                    is_opener[n] = True
+                    level += 1
+                    tails[n] = []
+                    stack.append(n)
+                elif re_middle is not None and re_middle.search(content):
+                    if stack:
+                        tails[stack[-1]].append(n)
+                elif re_closer.search(content):
+                    level -= 1
+                    if stack:
+                        tails[stack.pop()].append(n)
+            self.tails[(opener, "")] = tails
+
+            # A scan starting on a non-opener locks onto the next opener at the same level
+            next_opener = [0] * (self.line_count + 1)
+            next_at_level: Dict[int, int] = {}
+            for n in range(self.line_count, 0, -1):
+                if is_opener[n]:
+                    next_at_level[level_before[n]] = n
+                next_opener[n] = next_at_level.get(level_before[n], 0)
+            self.next_opener[opener] = next_opener
+
+    def last_end_line(self) -> int | None:
+        if self._last_end_line is None:
+            self._last_end_line = 0
+            for n in range(self.line_count, 0, -1):
+                content = self.code[n - 1]
+                if content is not None and RE_END_STMT.search(content):
+                    self._last_end_line = n
+                    break
+        return self._last_end_line or None
+
+    def last_labelled_end_line(self, label: str) -> int | None:
+        key = label.lower()
+        if key not in self._last_labelled_end_line:
+            re_end = re.compile(rf"^END\s+{re.escape(label)}\s*;", re.IGNORECASE)
+            self._last_labelled_end_line[key] = None
+            for n in range(self.line_count, 0, -1):
+                content = self.code[n - 1]
+                if content is not None and re_end.search(content):
+                    self._last_labelled_end_line[key] = n
+                    break
+        return self._last_labelled_end_line[key]
+
+    def tail_lines(self, start_line: int) -> List[int]:
+        """Middle branches and closers of the blocks a forward scan from start_line finds."""
+        out: List[int] = []
+        if start_line < 1 or start_line > self.line_count:
+            return out
+        for opener, _, _ in CONTROL_BLOCKS:
+            target = self.next_opener[opener][start_line]
+            if target:
+                out.extend(self.tails[(opener, "")][target])
+        labelled = self.labelled_openers.get(start_line)
+        if labelled:
+            out.extend(self.tails[labelled][start_line])
+        return out
+
+
+def function_block_index(function_lines: List[ESQLLine]) -> BlockIndex:
+    return BlockIndex([info.code.lstrip() if info.has_code else None for info in function_lines])
+
+
+# -----------------------------
+# Instrumentation (--stats, --profile)
+# -----------------------------
+
+# A phase hook is called with the phase name and returns a context manager wrapped around that phase
+PhaseHook = Callable[[str], ContextManager]
+
+
+def peak_rss_kb() -> Tuple[int | None, int | None]:
+    """Peak resident set size in KB of this process and of its largest finished child, if known."""
+    if resource is None:
+        return None, None
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    scale = 1024 if sys.platform == "darwin" else 1
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+
+
+class RunStats:
+    """Per-phase wall/CPU time, peak memory and counters of one evaluator run."""
+
+    def __init__(self):
+        self.phases: Dict[str, Dict[str, float | int | None]] = {}
+        self._current: Dict[str, float | int | None] | None = None
+
+    @contextmanager
+    def phase(self, name: str):
+        metrics: Dict[str, float | int | None] = {}
+        self.phases[name] = metrics
+        self._current = metrics
+        start_wall = time.perf_counter()
+        start_cpu = os.times()
+        try:
+            yield metrics
+        finally:
+            end_cpu = os.times()
+            metrics["wall_seconds"] = round(time.perf_counter() - start_wall, 6)
+            # Worker processes count once the pool has shut down (children_* are 0 on Windows)
+            metrics["cpu_seconds"] = round(sum(end_cpu[:4]) - sum(start_cpu[:4]), 6)
+            metrics["peak_rss_kb"], metrics["peak_child_rss_kb"] = peak_rss_kb()
+            if metrics.get("trace_lines") and metrics["wall_seconds"]:
+                metrics["trace_lines_per_second"] = round(metrics["trace_lines"] / metrics["wall_seconds"])
+            self._current = None
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Add to a counter of the running phase; ignored outside a phase."""
+        if self._current is not None:
+            self._current[name] = self._current.get(name, 0) + value
+
+    def set(self, name: str, value) -> None:
+        if self._current is not None:
+            self._current[name] = value
+
+    def as_dict(self) -> dict:
+        return {"phases": self.phases,
+                "total_wall_seconds": round(sum(m["wall_seconds"] for m in self.phases.values()), 6),
+                "total_cpu_seconds": round(sum(m["cpu_seconds"] for m in self.phases.values()), 6)}
+
+    def summary(self) -> List[str]:
+        out = [f"{'phase':<10}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}  counters"]
+        for name, metrics in self.phases.items():
+            rss = metrics.get("peak_rss_kb")
+            counters = ", ".join(f"{k}={v}" for k, v in metrics.items()
+                                 if k not in ("wall_seconds", "cpu_seconds", "peak_rss_kb", "peak_child_rss_kb"))
+            out.append(f"{name:<10}{metrics['wall_seconds']:>10.3f}{metrics['cpu_seconds']:>10.3f}"
+                       f"{(rss or 0) / 1024:>10.1f}  {counters}".rstrip())
+        return out
+
+
+def profile_phase_hook(phase: str, out_path: Path) -> PhaseHook:
+    """Phase hook running cProfile around one phase and writing pstats data to out_path.
+
+    hook.written tells whether the phase ran and the data was written.
+    """
+    @contextmanager
+    def hook(name: str):
+        if name != phase:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(str(out_path))
+            hook.written = True
+    hook.written = False
+    return hook
+
+
 # -----------------------------
 # Core logic (Python port of IAM2 evaluator) + SonarQube Generic Coverage XML output
 # -----------------------------
 
+class FunctionSource(NamedTuple):
+    """One function/procedure of a source file, as cut out by _parse_source_functions."""
+    number: int  # CREATE FUNCTION/PROCEDURE statements seen in its source file so far
+    key: str
+    body_start: int  # absolute file line of relative line 1
+    numbers: array  # relative line number of every body line (restarts after CREATE MODULE, as in IAM2)
+    text: List[str]  # body lines, parallel to numbers
+    lines: List[ESQLLine]  # lexer summaries parallel to numbers
+    blocks: BlockIndex | None  # precomputed for cached models, else built when the function was traced
+
+
+class SourceModel(NamedTuple):
+    """Everything evaluation needs from one source file; cached by SourceModelCache."""
+    schema_modules: List[str]
+    functions: List[FunctionSource]
+    function_starts: int
+
+
+class FunctionCoverage(NamedTuple):
+    """Coverage of one function/procedure of a source file, numbered globally when stored."""
+    number: int  # CREATE FUNCTION/PROCEDURE statements seen in its source file so far
+    key: str
+    stats: Tuple[int, int, int, int]
+    executed: List[int]  # executed relative lines; the details are rendered again when writing
+    coverage: Dict[int, bool]  # absolute file line -> covered
+    line_hits: Dict[int, int]
+    expansions: int  # traced (line, statement) entries expanded through the block index
+
+
+class SourceCoverage(NamedTuple):
+    """Functions of one source file and their coverage (parallel lists)."""
+    functions: List[FunctionSource]
+    coverage: List[FunctionCoverage]
+    function_starts: int
+
+
 class ESQLCoverageEvaluator:
-    def __init__(self, trace_log: Path, esql_source: Path, report_file: Path,
+    def __init__(self, trace_log: Path | Sequence[Path], esql_source: Path, report_file: Path | None,
                  pattern_file: Path = Path("tracelog.pattern"),
                  filter_modules_file: Path = Path("filterModules.txt"),
                  filter_funcs_file: Path = Path("filterFunctionProcedure.txt"),
-                 sonar_coverage_xml: Path | None = None):
-        self.trace_log = trace_log
+                 sonar_coverage_xml: Path | None = None,
+                 show_hit_counts: bool = False,
+                 parser: str = "regex",
+                 workers: int | None = None,
+                 shard_size: int = DEFAULT_TRACE_SHARD_SIZE,
+                 store: Path | None = None,
+                 cache_dir: Path | None = None,
+                 cache_size: int = DEFAULT_SOURCE_CACHE_SIZE,
+                 collect_stats: bool = False,
+                 phase_hooks: Sequence[PhaseHook] = (),
+                 snapshot_file: Path | None = None,
+                 snapshots: Sequence[Path] = (),
+                 trace_slice: TraceSlice | None = None,
+                 index_dir: Path | None = None,
+                 message_types_file: Path | None = None,
+                 impact_map_file: Path | None = None,
+                 test_markers: str | None = None,
+                 test_times: Path | None = None,
+                 results_file: Path | None = None,
+                 changed_lines: Dict[str, Set[int]] | None = None,
+                 jobs: int = 1):
+        # Several traces (e.g. rotated integration_server.trace.N.txt files) are merged
+        self.trace_logs: List[Path] = [trace_log] if isinstance(trace_log, Path) else list(trace_log)
+        # Merge mode: coverage comes from CoverageSnapshot files instead of traces
+        self.snapshots: List[Path] = list(snapshots)
+        self.trace_log = self.trace_logs[0] if self.trace_logs else None
         self.esql_source = esql_source
+        # A directory selects project mode: every ESQL/CMF file below it is evaluated
+        self.project_mode = esql_source.is_dir()
+        self.esql_sources: List[Path] = find_esql_sources(esql_source) if self.project_mode else [esql_source]
+        # Text report; None writes only the other outputs (e.g. just the snapshot)
         self.report_file = report_file
+        # Optional CoverageSnapshot written with the reports
+        self.snapshot_file = snapshot_file
         self.pattern_file = pattern_file
         self.filter_modules_file = filter_modules_file
         self.filter_funcs_file = filter_funcs_file
         self.sonar_coverage_xml = sonar_coverage_xml
+        self.show_hit_counts = show_hit_counts
+        self.parser = parser
+        # Process pool size for parsing trace files/shards and project sources; None = one per CPU
+        self.workers = workers
+        # Process pool size for evaluating the functions of the sources; 1 evaluates them here
+        self.jobs = jobs
+        # Byte size above which one trace is split across workers; 0 disables splitting
+        self.shard_size = shard_size
+        # Optional CoverageStore file; traces are then only read from the previous checkpoint on
+        self.store = store
+        # Optional SourceModelCache directory; unchanged sources are then not parsed again
+        self.source_cache = SourceModelCache(cache_dir, cache_size) if cache_dir is not None else None
+        # Optional part of the traces (threads, messages, time window), read through a TraceIndex
+        # per trace; the indexes are kept in index_dir (else rebuilt on every run)
+        self.trace_slice = trace_slice
+        self.index_dir = index_dir
+        self._trace_indexes: Dict[Path, TraceIndex] = {}
+        # Optional summary of the traced functions per message type (input node)
+        self.message_types_file = message_types_file
+        # Optional test impact map; test cases are delimited by marker lines or by a test times file
+        self.impact_map_file = impact_map_file
+        self.test_markers = re.compile(test_markers) if test_markers else None
+        self.test_windows: List[Tuple[str, str, str]] = read_test_windows(test_times) if test_times else []
+        if impact_map_file is not None and self.test_markers is None and not self.test_windows:
+            raise ValueError("An impact map needs test markers or test times")
+        # Optional per-function results of the previous run; only changed functions are evaluated again
+        self.results_file = results_file
+        # Changed file lines per source (from a diff or line ranges), keyed by the names used in
+        # project reports. Paths are resolved against the working directory, then the git
+        # repository of the sources, so same-named files in other directories do not match
+        names = {source.resolve(): self._source_name(source) for source in self.esql_sources}
+        source_dir = esql_source.resolve() if self.project_mode else esql_source.resolve().parent
+        repo_root = find_repo_root(source_dir)
+        bases = [Path.cwd()] if repo_root is None else [Path.cwd(), repo_root]
+        self.changed_lines: Dict[str, Set[int]] = {}
+        for path, lines in (changed_lines or {}).items():
+            for base in bases:
+                name = names.get((base / path.replace("\\", "/")).resolve())
+                if name is not None:
+                    self.changed_lines.setdefault(name, set()).update(lines)
+                    break
+        # Opt-in per-phase metrics, and context managers wrapped around every phase (e.g. a profiler)
+        self.stats: RunStats | None = RunStats() if collect_stats else None
+        self.phase_hooks: List[PhaseHook] = list(phase_hooks)
 
-        # Globals/aggregates analogous to the Perl script
-        self.extracted_log_entries: List[Tuple[str, int, str]] = []  # (function, relative_line, statement)
         self.esql_schema_modules: List[str] = []
-        self.function_counter: int = 0
-        self.result_lines: List[str] = []
-        self.esql_module_func_stats: Dict[str, Tuple[int, int, int, int]] = {}
-        self.total_executed_lines: int = 0
-        self.total_executable_lines: int = 0
-
-        # SonarQube coverage map: file path -> line number -> covered(bool)
-        self.sonar_coverage_map: Dict[str, Dict[int, bool]] = {}
-
-        # Precompile regex pieces used multiple times
-        self.re_comment_line = re.compile(r"^\d+:\s+--")
-        self.re_block_comment_start = re.compile(r"^\d+:\s*/\*")
-        self.re_block_comment_end_anywhere = re.compile(r"\*/\s*$")
+        self._reset_run_state()
 
         # Load optional filters
         self.modules_to_filter: Set[str] = set()
@@ -59,7 +1531,50 @@ class ESQLCoverageEvaluator:
         if self.filter_funcs_file.exists():
             self.funcs_to_filter = {ln.strip() for ln in read_text_lines(self.filter_funcs_file) if ln.strip()}
 
-        # Pattern from tracelog.pattern (supports comments and multiple entries)
+        self._snapshot: CoverageSnapshot | None = None
+        if self.snapshots:
+            # Snapshots hold evaluated lines; no trace is parsed
+            self.trace_pattern = None
+            self.trace_parser = None
+        else:
+            self._load_trace_pattern()
+
+        # Load inputs; the trace log is streamed in _extract_from_log
+        for trace_log in self.trace_logs:
+            if not trace_log.exists():
+                raise FileNotFoundError(f"Trace log not found: {trace_log}")
+        # Sources are parsed (or read from the cache) in _discover_schema_modules
+        if self.project_mode:
+            if not self.esql_sources:
+                raise FileNotFoundError(f"No ESQL/CMF sources found in: {esql_source}")
+        elif not self.esql_source.is_file():
+            raise FileNotFoundError(f"ESQL source not found: {esql_source}")
+        self._source_models: List[SourceModel] = []
+
+    def _reset_run_state(self) -> None:
+        """Per-run aggregates (phases 2-4); the parsed sources of phase 1 are kept."""
+        # Globals/aggregates analogous to the Perl script
+        # (function, relative_line, statement) -> number of times it was traced
+        self.extracted_log_entries: Dict[Tuple[str, int, str], int] = {}
+        # Lookup structures built once after trace extraction (see _build_entry_index)
+        self._function_ids: Dict[str, int] = {}  # lowercased traced function -> id
+        self._function_names: List[str] = []  # id -> lowercased traced function
+        self._function_entries: List[Dict[Tuple[int, str], int]] = []  # id -> (line, statement) -> hits
+        self._functions_by_name: Dict[str, List[int]] = {}  # last name segment -> ids
+        self.function_counter: int = 0
+        # Report details in output order: (number, label, function, coverage); rendered while writing
+        self._report_sections: List[Tuple[int, str, FunctionSource, FunctionCoverage]] = []
+        self.esql_module_func_stats: Dict[str, Tuple[int, int, int, int]] = {}
+        self.total_executed_lines: int = 0
+        self.total_executable_lines: int = 0
+
+        # SonarQube coverage map: file path -> line number -> covered(bool)
+        self.sonar_coverage_map: Dict[str, Dict[int, bool]] = {}
+        # Per source file (parallel to esql_sources): its functions and their coverage
+        self._source_coverage: List[SourceCoverage] = []
+
+    def _load_trace_pattern(self) -> None:
+        """Pattern from tracelog.pattern (supports comments and multiple entries)."""
         if not self.pattern_file.exists():
             raise FileNotFoundError(f"Required pattern file not found: {self.pattern_file}")
         raw = self.pattern_file.read_text(encoding="utf-8", errors="ignore")
@@ -73,154 +1588,531 @@ class ESQLCoverageEvaluator:
             raise ValueError("tracelog.pattern contained no usable (non-comment) patterns")
         combined = "|".join(f"(?:{p})" for p in lines)
         self.trace_pattern = re.compile(combined, flags=re.IGNORECASE | re.VERBOSE)
-
-        # Load inputs
-        self.log_lines = read_text_lines(self.trace_log)
-        self.esql_lines = read_text_lines(self.esql_source)
+        self.trace_parser = TraceLineParser(self.trace_pattern, self.parser)
+
+    def __getstate__(self):
+        # Project workers receive their source models as map items, not with the evaluator
+        state = self.__dict__.copy()
+        state["_source_models"] = []
+        state["_source_coverage"] = []
+        state["stats"] = None
+        state["phase_hooks"] = []
+        state["_snapshot"] = None
+        return state
+
+    @contextmanager
+    def _phase(self, name: str):
+        with ExitStack() as stack:
+            if self.stats is not None:
+                stack.enter_context(self.stats.phase(name))
+            for hook in self.phase_hooks:
+                stack.enter_context(hook(name))
+            yield
 
     # -------------------------
-    # Phase 1: Scan source to discover schema and module names
+    # Phase 1: Parse sources and discover schema and module names
     # -------------------------
     def _discover_schema_modules(self) -> None:
-        current_schema = ""
-
-        re_named_schema = re.compile(r"\bCREATE\s+SCHEMA\s+([A-Za-z0-9_.]+)\s+PATH", re.IGNORECASE)
-        re_default_schema = re.compile(r"\bCREATE\s+SCHEMA\s+""\s+PATH", re.IGNORECASE)
-        re_module = re.compile(r"\bCREATE\s+(?:COMPUTE|FILTER|DATABASE)\s+MODULE\s+(.+)$", re.IGNORECASE)
-
-        for raw in self.esql_lines:
-            line = raw.rstrip()
-            m = re_named_schema.search(line)
-            if m:
-                current_schema = m.group(1).strip()
-                self.esql_schema_modules.append(current_schema)
-                continue
-            if re_default_schema.search(line):
-                current_schema = ""
-                continue
-            m2 = re_module.search(line)
-            if m2:
-                esql_module = m2.group(1).strip()
-                esql_module = esql_module.split("&#xd;", 1)[0].strip()
-                full = f"{current_schema}.{esql_module}" if current_schema else f".{esql_module}"
-                self.esql_schema_modules.append(full)
-        self.esql_schema_modules.append("")
-        self.esql_schema_modules = sorted(set(self.esql_schema_modules))
+        if self.project_mode:
+            self._source_models = self._map_sources(self._load_source_model, _load_source_model_worker, self.esql_sources)
+        else:
+            self._source_models = [self._load_source_model(self.esql_source)]
+        if self.source_cache is not None:
+            self.source_cache.evict()
+        self.esql_schema_modules = sorted({m for model in self._source_models for m in model.schema_modules})
+        if self.stats is not None:
+            self.stats.set("sources", len(self._source_models))
+            self.stats.set("functions", sum(len(model.functions) for model in self._source_models))
+            self.stats.set("schema_modules", len(self.esql_schema_modules))
+
+    def _load_source_model(self, source: Path) -> SourceModel:
+        data = source.read_bytes()
+        if self.source_cache is None:
+            return self._parse_source_model(data, with_blocks=False)
+        # Filtered modules/functions are left out of the model, so they are part of the key
+        key = SourceModelCache.key(data, "\n".join(sorted(self.modules_to_filter)),
+                                   "\n".join(sorted(self.funcs_to_filter)))
+        model = self.source_cache.get(key)
+        if model is None:
+            model = self._parse_source_model(data, with_blocks=True)
+            self.source_cache.put(key, model)
+        return model
+
+    def _parse_source_model(self, data: bytes, with_blocks: bool) -> SourceModel:
+        # Same lines as read_text_lines()
+        esql_lines = data.decode("utf-8", errors="ignore").splitlines()
+        esql_line_info = tokenize_esql(esql_lines)
+        functions, function_starts = self._parse_source_functions(esql_lines, esql_line_info)
+        if with_blocks:
+            functions = [f._replace(blocks=function_block_index(f.lines)) for f in functions]
+        return SourceModel(discover_schema_modules(esql_line_info), functions, function_starts)
+
+    def _map_sources(self, method, worker, items: list) -> list:
+        """Apply a method to one item per project source, in source order.
+
+        With more than one worker, the items go to worker processes through `worker`, the
+        module-level function calling `method` there. The serial path calls `method` itself:
+        the module globals are per process, and the server evaluates requests on threads.
+        """
+        workers = min(self.workers or os.cpu_count() or 1, len(items))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_source_worker,
+                                     initargs=(self,)) as pool:
+                return list(pool.map(worker, items))
+        return [method(item) for item in items]
 
     # -------------------------
     # Phase 2: Extract executed statements from trace log
     # -------------------------
     def _extract_from_log(self) -> None:
-        for line in self.log_lines:
-            m = self.trace_pattern.search(line)
-            if not m:
-                continue
-            # Prefer named groups if present
-            gd = m.groupdict()
-            function = (gd.get('func') or (m.group(1) if m.lastindex and m.lastindex >= 1 else '') or '').strip()
-            relative_line = (gd.get('line') or (m.group(2) if m.lastindex and m.lastindex >= 2 else '') or '').strip()
-            if not function or not relative_line:
-                continue
+        if not self.trace_logs:
+            raise ValueError("At least one trace log is required")
+        known_schema_modules = frozenset(self.esql_schema_modules)
+        if self.store is not None:
+            self._extract_incremental(known_schema_modules)
+        else:
+            if self.trace_slice is not None:
+                tasks = self._plan_slice_tasks(self.trace_slice)
+            else:
+                tasks = [(trace_log, byte_range)
+                         for trace_log in self.trace_logs
+                         for byte_range in self._plan_trace_tasks(trace_log, 0, None)]
+            for partial in self._run_trace_tasks(tasks, known_schema_modules):
+                self._merge_hits(partial)
+        self._build_entry_index()
+        if self.stats is not None:
+            self.stats.set("unique_hits", len(self.extracted_log_entries))
+            self.stats.set("total_hits", sum(self.extracted_log_entries.values()))
+            self.stats.set("traced_functions", len(self._function_names))
+
+    def _extract_incremental(self, known_schema_modules: frozenset) -> None:
+        """Parse only the part of each trace added since the last run and merge it into the store."""
+        with CoverageStore(self.store) as store:
+            store.reset_if_changed(self.trace_pattern.pattern)
+            self._read_new_trace_hits(store)
+            self._merge_hits({key: count for key, count in store.load_hits()
+                              if self._is_known_function(key[0], known_schema_modules)})
+
+    def _read_new_trace_hits(self, store: CoverageStore, following: bool = False) -> Dict[Tuple[str, int, str], int]:
+        """Parse the lines appended to each trace since its checkpoint; returns and records their hits.
+
+        While following, a last line without a line break is still being written and is left
+        for the next refresh; otherwise the trace is read to its end. The hits are unfiltered,
+        so later runs may know more schemas/modules.
+        """
+        tasks: List[Tuple[Path, Tuple[int, int] | None]] = []
+        checkpoints: List[Tuple[Path, int]] = []
+        for trace_log in self.trace_logs:
             try:
-                rel = int(float(relative_line))
-            except Exception:
+                start = store.resume_offset(trace_log)
+                if compressed_trace_opener(trace_log) is not None:
+                    # A compressed stream cannot be resumed mid-way: read once as a whole and
+                    # checkpointed at its file size, so it is skipped while unchanged
+                    size = trace_log.stat().st_size
+                    if start == 0:
+                        tasks.append((trace_log, None))
+                        checkpoints.append((trace_log, size))
+                    elif start != size:
+                        print(f"Warning: compressed trace {trace_log} changed since it was read; "
+                              f"not reading it again (remove it from the store to start over)")
+                    continue
+                end = complete_lines_end(trace_log, start) if following else trace_log.stat().st_size
+            except FileNotFoundError:
+                # Rotated away while following; its new name is picked up on the next refresh
                 continue
+            if end > start:
+                tasks.extend((trace_log, byte_range) for byte_range in self._plan_trace_tasks(trace_log, start, end))
+                checkpoints.append((trace_log, end))
+        new_hits: Dict[Tuple[str, int, str], int] = {}
+        for partial in self._run_trace_tasks(tasks, None):
+            for key, count in partial.items():
+                new_hits[key] = new_hits.get(key, 0) + count
+        if checkpoints:
+            store.record(new_hits, checkpoints)
+        return new_hits
+
+    def _load_snapshots(self) -> None:
+        """Merge mode: add up the coverage snapshots and check they match the sources."""
+        self._snapshot = CoverageSnapshot()
+        for path in self.snapshots:
+            self._snapshot.load(path)
+        names = set()
+        for source in self.esql_sources:
+            name = self._source_name(source)
+            names.add(name)
+            digest = self._snapshot.digests.get(name)
+            if digest is not None and digest != file_digest(source):
+                raise ValueError(f"Coverage snapshots were taken from another version of {source}")
+        unknown = sorted(set(self._snapshot.digests) - names)
+        if unknown:
+            print(f"Warning: snapshots cover sources that are not evaluated: {', '.join(unknown)}")
+        if self.stats is not None:
+            self.stats.set("snapshots", len(self.snapshots))
+            self.stats.set("traced_functions", len(self._snapshot.functions))
 
-            # Extract statement between the first and last quotes before ' at '
-            stmt = ""
-            try:
-                at_idx = line.rfind(" at ")
-                # Find last single quote before ' at '
-                last_q = line.rfind("'", 0, at_idx)
-                # Find first single quote before that
-                first_q = line.find("'", 0, last_q)
-                if first_q != -1 and last_q != -1 and last_q > first_q:
-                    stmt = line[first_q + 1:last_q]
-            except ValueError:
-                stmt = ""
-            stmt = stmt.strip()
-
-            schema_and_module = function.rsplit(".", 1)[0] if "." in function else ""
-
-            if function not in (".statusACTIVE", ".statusINACTIVE"):
-                for known in self.esql_schema_modules:
-                    if known == schema_and_module:
-                        self.extracted_log_entries.append((function, rel, stmt))
-                        break
+    @staticmethod
+    def _is_known_function(function: str, known_schema_modules: frozenset) -> bool:
+        schema_and_module = function.rsplit(".", 1)[0] if "." in function else ""
+        return function not in IGNORED_TRACE_FUNCTIONS and schema_and_module in known_schema_modules
+
+    def _plan_trace_tasks(self, trace_log: Path, start: int, end: int | None) -> List[Tuple[int, int] | None]:
+        """Byte ranges of one trace to parse; [None] stands for the whole file read as a stream."""
+        if start == 0 and end is None and compressed_trace_opener(trace_log) is not None:
+            # Compressed traces are decoded sequentially; byte ranges are only meaningful for plain text
+            return [None]
+        shards = plan_trace_shards(trace_log, self.shard_size, start, end)
+        if len(shards) == 1 and start == 0 and end is None:
+            return [None]
+        return shards
+
+    def _trace_index(self, trace_log: Path) -> TraceIndex:
+        """TraceIndex of one trace, brought up to date (and saved, with index_dir)."""
+        index = self._trace_indexes.get(trace_log)
+        if index is None:
+            index_path = trace_index_path(self.index_dir, trace_log) if self.index_dir is not None else None
+            index = TraceIndex.load(index_path) if index_path is not None else TraceIndex()
+            indexed = index.end
+            index.update(trace_log)
+            if index_path is not None and index.end != indexed:
+                index.save(index_path)
+            self._trace_indexes[trace_log] = index
+        return index
+
+    def _plan_slice_tasks(self, trace_slice: TraceSlice) -> List[Tuple[Path, List[Tuple[int, int]]]]:
+        """Byte ranges of a trace slice, grouped into tasks of about shard_size bytes.
+
+        Threads and the time window narrow the selection; messages given by number and by
+        input node add up. Messages are numbered across the traces in their given order.
+        """
+        since = trace_seconds(trace_slice.since) if trace_slice.since else None
+        until = trace_seconds(trace_slice.until) if trace_slice.until else None
+        tasks: List[Tuple[Path, List[Tuple[int, int]]]] = []
+        first_message = 1
+        for trace_log in self.trace_logs:
+            index = self._trace_index(trace_log)
+            message_count = len(index.message_threads)
+            messages: Set[int] = set()
+            if trace_slice.messages or trace_slice.nodes:
+                messages = {n - first_message for n in trace_slice.messages
+                            if first_message <= n < first_message + message_count}
+                messages |= index.messages_of_nodes(trace_slice.nodes)
+            first_message += message_count
+            if (trace_slice.messages or trace_slice.nodes) and not messages:
+                continue
+            chunk: List[Tuple[int, int]] = []
+            chunk_size = 0
+            for start, end in index.byte_ranges(trace_slice.threads, messages, since, until):
+                chunk.append((start, end))
+                chunk_size += end - start
+                if 0 < self.shard_size <= chunk_size:
+                    tasks.append((trace_log, chunk))
+                    chunk, chunk_size = [], 0
+            if chunk:
+                tasks.append((trace_log, chunk))
+        if self.stats is not None:
+            self.stats.set("slice_bytes", sum(end - start for _, ranges in tasks for start, end in ranges))
+        return tasks
+
+    def _run_trace_tasks(self, tasks: List[Tuple[Path, Tuple[int, int] | List[Tuple[int, int]] | None]],
+                         known_schema_modules: frozenset | None) -> Iterator[Dict[Tuple[str, int, str], int]]:
+        """Partial hit counts of every (trace, byte range(s)) task; counting is order independent."""
+        time_window = self.trace_slice.time_window() if self.trace_slice is not None else None
+        workers = min(self.workers or os.cpu_count() or 1, len(tasks))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = pool.map(scan_trace, [t for t, _ in tasks], repeat(self.trace_parser),
+                                   repeat(known_schema_modules), [r for _, r in tasks], repeat(time_window))
+                for hits, counts in results:
+                    self._count_trace_scan(counts)
+                    yield hits
+        else:
+            for trace_log, byte_range in tasks:
+                hits, counts = scan_trace(trace_log, self.trace_parser, known_schema_modules, byte_range,
+                                          time_window)
+                self._count_trace_scan(counts)
+                yield hits
+
+    def _count_trace_scan(self, counts: Dict[str, int]) -> None:
+        if self.stats is None:
+            return
+        for name, value in counts.items():
+            self.stats.count(name, value)
+        self.stats.count("rejected_lines", counts["trace_lines"] - counts["matched_lines"])
+
+    def _merge_hits(self, hits: Dict[Tuple[str, int, str], int]) -> None:
+        for key, count in hits.items():
+            self.extracted_log_entries[key] = self.extracted_log_entries.get(key, 0) + count
+
+    def _build_entry_index(self) -> None:
+        """Group extracted entries by traced function (an integer id per lowercased name).
+
+        A function/procedure picks up all traced functions whose name ends with its key.
+        Such a name ends with the key's last segment, so the ids are indexed by that segment
+        and only its few candidates are compared instead of all extracted entries.
+        """
+        self._function_ids = {}
+        self._function_names = []
+        self._function_entries = []
+        self._functions_by_name = {}
+        self._index_hits(self.extracted_log_entries)
+
+    def _index_hits(self, hits: Dict[Tuple[str, int, str], int]) -> Set[int]:
+        """Add hits to the entry index; returns the ids of the traced functions they belong to."""
+        ids: Set[int] = set()
+        for (func, rel, stmt), count in hits.items():
+            func = func.lower()
+            func_id = self._function_ids.get(func)
+            if func_id is None:
+                func_id = self._function_ids[func] = len(self._function_names)
+                self._function_names.append(func)
+                self._function_entries.append({})
+                self._functions_by_name.setdefault(func.rsplit(".", 1)[-1], []).append(func_id)
+            entries = self._function_entries[func_id]
+            entries[(rel, stmt)] = entries.get((rel, stmt), 0) + count
+            ids.add(func_id)
+        return ids
+
+    def _traced_function_ids(self, esql_key: str, candidates: Set[int] | None = None) -> List[int]:
+        """Ids of the traced functions whose name ends with esql_key (which always contains a '.')."""
+        key = esql_key.lower()
+        return [func_id for func_id in self._functions_by_name.get(key.rsplit(".", 1)[-1], ())
+                if (candidates is None or func_id in candidates) and self._function_names[func_id].endswith(key)]
 
     # -------------------------
     # Phase 3: Parse ESQL and accumulate coverage per function/procedure
     # -------------------------
     def _process_esql(self) -> None:
+        if self._snapshot is not None:
+            # Rendering only; the lines were expanded when the snapshots were taken
+            coverage = [self._snapshot_source_coverage(source, model)
+                        for source, model in zip(self.esql_sources, self._source_models)]
+        elif self.results_file is not None:
+            coverage = self._evaluate_changed_functions()
+        elif self.jobs > 1:
+            coverage = self._evaluate_functions_parallel()
+        elif self.project_mode:
+            coverage = self._map_sources(self._evaluate_source, _evaluate_source_worker, self._source_models)
+        else:
+            coverage = [self._evaluate_source(model) for model in self._source_models]
+        self._source_coverage = [SourceCoverage(model.functions, functions, model.function_starts)
+                                 for model, functions in zip(self._source_models, coverage)]
+        self._store_coverage()
+        if self.stats is not None:
+            evaluated = [function for functions in coverage for function in functions]
+            self.stats.set("functions", len(evaluated))
+            self.stats.set("traced_functions", sum(1 for function in evaluated if function.executed))
+            self.stats.set("block_expansions", sum(function.expansions for function in evaluated))
+
+    def _store_coverage(self) -> None:
+        """(Re)build the report state from _source_coverage, in source order."""
+        self.function_counter = 0
+        self._report_sections = []
+        self.esql_module_func_stats = {}
+        self.sonar_coverage_map = {}
+        # Merged in source order, so the report does not depend on worker scheduling
+        for source, result in zip(self.esql_sources, self._source_coverage):
+            self._store_source_coverage(source, result)
+
+    def _evaluate_source(self, model: SourceModel) -> List[FunctionCoverage]:
+        return [self._evaluate_function(function) for function in model.functions]
+
+    def _evaluate_functions_parallel(self) -> List[List[FunctionCoverage]]:
+        """Evaluate the functions of all sources on `jobs` worker processes.
+
+        Functions are independent once the trace hits are indexed, so they are sent in
+        contiguous batches (source, first, end) of about equal line counts. Batches come
+        back in submission order and are concatenated per source, giving the same lists
+        as the serial loop; numbering and report order are assigned afterwards.
+        """
+        total_lines = sum(len(f.lines) for model in self._source_models for f in model.functions)
+        # A few batches per process, so a batch of large functions does not hold up the rest
+        batch_lines = max(total_lines // (self.jobs * FUNCTION_BATCHES_PER_JOB), 1)
+        batches: List[Tuple[int, int, int]] = []
+        for index, model in enumerate(self._source_models):
+            first, lines = 0, 0
+            for n, function in enumerate(model.functions):
+                lines += len(function.lines)
+                if lines >= batch_lines:
+                    batches.append((index, first, n + 1))
+                    first, lines = n + 1, 0
+            if first < len(model.functions):
+                batches.append((index, first, len(model.functions)))
+        coverage: List[List[FunctionCoverage]] = [[] for _ in self._source_models]
+        workers = min(self.jobs, len(batches))
+        if workers <= 1:
+            for index, model in enumerate(self._source_models):
+                coverage[index] = self._evaluate_source(model)
+            return coverage
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_source_worker,
+                                 initargs=(self, self._source_models)) as pool:
+            for (index, _, _), functions in zip(batches, pool.map(_evaluate_functions_worker, batches)):
+                coverage[index].extend(functions)
+        return coverage
+
+    def _evaluate_changed_functions(self) -> List[List[FunctionCoverage]]:
+        """Evaluate only the functions whose body or traced hits differ from the previous results.
+
+        Results are kept per (source, function key, occurrence) with a function_fingerprint;
+        the coverage of the others is taken over, moved to the function's current position.
+        Functions touching changed_lines are always evaluated. The results file is rewritten.
+        """
+        previous: Dict[Tuple[str, str, int], tuple] = {}
+        try:
+            with open(self.results_file, "rb") as f:
+                data = pickle.load(f)
+            if data.get("tool") == tool_fingerprint():
+                previous = data["functions"]
+        except FileNotFoundError:
+            pass
+        except Exception:
+            print(f"Warning: ignoring unreadable results file {self.results_file}")
+        results: Dict[Tuple[str, str, int], tuple] = {}
+        coverage: List[List[FunctionCoverage]] = []
+        reused = 0
+        for source, model in zip(self.esql_sources, self._source_models):
+            name = self._source_name(source)
+            changed = self.changed_lines.get(name, set())
+            occurrences: Dict[str, int] = {}
+            functions: List[FunctionCoverage] = []
+            for function in model.functions:
+                occurrence = occurrences[function.key] = occurrences.get(function.key, -1) + 1
+                result_key = (name, function.key, occurrence)
+                entries = [entry for func_id in self._traced_function_ids(function.key)
+                           for entry in self._function_entries[func_id].items()]
+                fingerprint = function_fingerprint(function, entries)
+                old = previous.get(result_key)
+                body_end = function.body_start + len(function.numbers)
+                if (old is not None and old[0] == fingerprint
+                        and not any(function.body_start <= n < body_end for n in changed)):
+                    _, stats, executed, relative_coverage, line_hits = old
+                    result = FunctionCoverage(function.number, function.key, stats, executed,
+                                              {function.body_start + n: c for n, c in relative_coverage.items()},
+                                              line_hits, 0)
+                    reused += 1
+                else:
+                    result = self._evaluate_function(function)
+                functions.append(result)
+                results[result_key] = (fingerprint, result.stats, result.executed,
+                                       {n - function.body_start: c for n, c in result.coverage.items()},
+                                       result.line_hits)
+            coverage.append(functions)
+        self.results_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.results_file.with_name(f"{self.results_file.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump({"tool": tool_fingerprint(), "functions": results}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.results_file)
+        if self.stats is not None:
+            self.stats.set("reused_functions", reused)
+        return coverage
+
+    def changed_line_coverage(self) -> List[Tuple[str, int, str, bool]]:
+        """(source, file line, function, covered) of every changed executable line, in source order."""
+        out: List[Tuple[str, int, str, bool]] = []
+        for source, result in zip(self.esql_sources, self._source_coverage):
+            name = self._source_name(source)
+            changed = self.changed_lines.get(name)
+            if not changed:
+                continue
+            for function in result.coverage:
+                for n in sorted(changed.intersection(function.coverage)):
+                    out.append((name, n, function.key, function.coverage[n]))
+        return out
+
+    def iter_changed_lines_report(self) -> Iterator[str]:
+        lines = self.changed_line_coverage()
+        yield "Coverage of changed lines\n"
+        yield "-------------------------\n"
+        current = None
+        for name, n, key, covered in lines:
+            if name != current:
+                yield f"\n{name}\n"
+                current = name
+            yield f"{'[x]' if covered else '[ ]'} {n}: '{key}'\n"
+        covered = sum(1 for line in lines if line[3])
+        percent = covered / len(lines) * 100 if lines else 100.0
+        yield f"\nChanged Executed Lines : {covered} of {len(lines)} executable lines\n"
+        yield f"Changed Code Coverage : {percent:.1f}%\n"
+
+    def _parse_source_functions(self, esql_lines: List[str],
+                                esql_line_info: List[ESQLLine]) -> Tuple[List[FunctionSource], int]:
+        """Cut one source file into its functions/procedures; also returns the number of function starts."""
+        functions: List[FunctionSource] = []
+        function_starts = 0
         current_schema = ""
         current_module = ""
         begin_filtered_module = False
         in_func_proc = False
-        function_indexed: List[str] = []
+        function_numbers = array("I")
+        function_text: List[str] = []
+        function_lines: List[ESQLLine] = []  # lexer summaries parallel to function_text
         function_line_counter = 1
         esql_schema_module_function = ""
-        function_body_start_file_line = 0  # absolute file line number of "1:" within function_indexed
-
-        re_named_schema = re.compile(r"\bCREATE\s+SCHEMA\s+([A-Za-z0-9_.]+)\s+PATH", re.IGNORECASE)
-        re_default_schema = re.compile(r"\bCREATE\s+SCHEMA\s+""\s+PATH", re.IGNORECASE)
-        re_module = re.compile(r"\bCREATE\s+(?:COMPUTE|FILTER|DATABASE)\s+MODULE\s+(.+)$", re.IGNORECASE)
-        re_end_module = re.compile(r"\bEND\s+MODULE;", re.IGNORECASE)
-        re_func_or_proc = re.compile(r"\bCREATE\s+(?:FUNCTION|PROCEDURE)\s+(\w+)\s*\(", re.IGNORECASE)
-        re_end_stmt_variants = re.compile(r"(^|\s)END\s*;\s*$", re.IGNORECASE)
+        function_body_start_file_line = 0  # absolute file line number of relative line 1
 
         seen_atomic_block = False
         seen_case_block = False
 
-        for file_line_no, raw in enumerate(self.esql_lines, start=1):
+        for file_line_no, (raw, info) in enumerate(zip(esql_lines, esql_line_info), start=1):
             line = raw.rstrip("\n\r")
+            code = info.code
+            # Cheap keyword gates; the patterns below only run on lines that can match
+            upper = code.upper()
+            has_create = "CREATE" in upper
+            has_end = "END" in upper
 
-            m = re_named_schema.search(line)
+            m = RE_NAMED_SCHEMA.search(code) if has_create else None
             if m:
                 current_schema = m.group(1).strip()
                 current_module = ""
                 in_func_proc = False
                 function_line_counter = 1
-                function_indexed = []
+                function_numbers = array("I")
+                function_text = []
                 continue
-            if re_default_schema.search(line):
+            if has_create and RE_DEFAULT_SCHEMA.search(code):
                 current_schema = ""
                 current_module = ""
                 in_func_proc = False
                 function_line_counter = 1
-                function_indexed = []
+                function_numbers = array("I")
+                function_text = []
                 continue
 
-            m = re_module.search(line)
+            m = RE_MODULE.search(code) if has_create else None
             if m:
                 function_line_counter = 1
                 current_module = m.group(1).strip()
-                current_module = current_module.split("&#xd;", 1)[0].strip()
                 begin_filtered_module = current_module in self.modules_to_filter
                 continue
 
-            if re_end_module.search(line):
+            if has_end and RE_END_MODULE.search(code):
                 begin_filtered_module = False
                 current_module = ""
                 continue
 
-            if re.search(r"\bBEGIN\s+ATOMIC\b", line, re.IGNORECASE):
+            if "ATOMIC" in upper and RE_BEGIN_ATOMIC.search(code):
                 seen_atomic_block = True
-            if re.search(r"\bCASE\b", line):
-                seen_case_block = True
-            if re.search(r"\bEND\s+CASE\s*;", line, re.IGNORECASE):
-                seen_case_block = False
+            if "CASE" in upper:
+                if RE_CASE.search(code):
+                    seen_case_block = True
+                if has_end and RE_END_CASE.search(code):
+                    seen_case_block = False
 
-            m = re_func_or_proc.search(line)
+            m = RE_FUNC_OR_PROC.search(code) if has_create else None
             if m:
                 name = m.group(1)
                 if begin_filtered_module or (name in self.funcs_to_filter):
                     in_func_proc = False
-                    function_indexed = []
+                    function_numbers = array("I")
+                    function_text = []
+                    function_lines = []
                     function_line_counter = 1
                     continue
                 in_func_proc = True
-                self.function_counter += 1
-                function_indexed = []
+                function_starts += 1
+                function_numbers = array("I")
+                function_text = []
+                function_lines = []
                 function_line_counter = 1
                 function_body_start_file_line = file_line_no + 1  # first body line (next line) will be numbered 1
                 if current_schema:
@@ -236,10 +2128,12 @@ class ESQLCoverageEvaluator:
                 continue
 
             if in_func_proc:
-                function_indexed.append(f"{function_line_counter}: {line}")
+                function_numbers.append(function_line_counter)
+                function_text.append(line)
+                function_lines.append(info)
                 function_line_counter += 1
 
-            if re_end_stmt_variants.search(line):
+            if has_end and RE_END_STMT_VARIANTS.search(code):
                 if seen_atomic_block:
                     seen_atomic_block = False
                     continue
@@ -248,170 +2142,121 @@ class ESQLCoverageEvaluator:
                     continue
 
                 if in_func_proc:
-                    func_exec_lines = self._collect_executed_lines_for(esql_schema_module_function,
-                                                                      function_indexed)
-                    stats, rendered, executable_rel, executed_rel = self._calculate_and_store_function_indicator(
-                        esql_schema_module_function,
-                        function_indexed,
-                        func_exec_lines,
-                    )
-                    self.esql_module_func_stats[esql_schema_module_function] = stats
-                    self.result_lines.extend(rendered)
-
-                    # Update SonarQube coverage map using absolute file lines
-                    file_key = str(self.esql_source)
-                    file_map = self.sonar_coverage_map.setdefault(file_key, {})
-                    for n in sorted(executable_rel):
-                        abs_line = function_body_start_file_line + n - 1
-                        covered = (n in executed_rel)
-                        # If line already present, once covered, keep covered=True
-                        file_map[abs_line] = file_map.get(abs_line, False) or covered
+                    functions.append(FunctionSource(
+                        function_starts, esql_schema_module_function, function_body_start_file_line,
+                        function_numbers, function_text, function_lines, None))
 
                     in_func_proc = False
                     function_line_counter = 1
-                    function_indexed = []
+                    function_numbers = array("I")
+                    function_text = []
+                    function_lines = []
                     esql_schema_module_function = ""
                 else:
                     esql_schema_module_function = ""
+        return functions, function_starts
+
+    def _snapshot_source_coverage(self, source: Path, model: SourceModel) -> List[FunctionCoverage]:
+        name = self._source_name(source)
+        out: List[FunctionCoverage] = []
+        for function in model.functions:
+            executed, line_hits = self._snapshot.functions.get((name, function.body_start, function.key), ((), {}))
+            out.append(self._function_coverage(function, sorted(executed), dict(line_hits), 0))
+        return out
+
+    def _evaluate_function(self, function: FunctionSource) -> FunctionCoverage:
+        func_exec_lines, line_hits, expansions = self._collect_executed_lines_for(function)
+        return self._function_coverage(function, func_exec_lines, line_hits, expansions)
+
+    def _function_coverage(self, function: FunctionSource, func_exec_lines: List[int], line_hits: Dict[int, int],
+                           expansions: int) -> FunctionCoverage:
+        stats, _, executable_rel, executed_rel = self._calculate_and_store_function_indicator(
+            function,
+            func_exec_lines,
+            line_hits,
+        )
+        # SonarQube coverage using absolute file lines
+        coverage = {function.body_start + n - 1: (n in executed_rel) for n in sorted(executable_rel)}
+        return FunctionCoverage(function.number, function.key, stats, func_exec_lines, coverage, line_hits,
+                                expansions)
+
+    def _source_name(self, source: Path) -> str:
+        """Name of a source in project reports and snapshots: its path relative to the project directory."""
+        return source.relative_to(self.esql_source).as_posix() if self.project_mode else source.name
+
+    def _store_source_coverage(self, source: Path, result: SourceCoverage) -> None:
+        # Project reports qualify functions with their file; the same module may live in several
+        prefix = f"{self._source_name(source)}:" if self.project_mode else ""
+        for function_source, function in zip(result.functions, result.coverage):
+            label = prefix + function.key
+            self.esql_module_func_stats[label] = function.stats
+            self._report_sections.append((self.function_counter + function.number, label, function_source, function))
+
+            file_map = self.sonar_coverage_map.setdefault(str(source), {})
+            for abs_line, covered in function.coverage.items():
+                # If line already present, once covered, keep covered=True
+                file_map[abs_line] = file_map.get(abs_line, False) or covered
+        self.function_counter += result.function_starts
 
     # -------------------------
     # Helpers for phase 3
     # -------------------------
-    def _collect_executed_lines_for(self, esql_key: str, function_indexed: List[str]) -> List[int]:
-        exec_lines: List[int] = []
-        for func, rel, stmt in self.extracted_log_entries:
-            if func.lower().endswith(esql_key.lower()):
-                exec_lines.append(rel)
-                exec_lines.extend(self._add_BEGIN_tail_and_header(stmt, function_indexed))
-                exec_lines.extend(self._add_atomic_tail_and_header(stmt, function_indexed))
-                exec_lines.extend(self._add_tail("IF", "END IF", function_indexed, start_line=rel, middle="ELSE"))
-                exec_lines.extend(self._add_named_tail("IF", "END IF", function_indexed, start_line=rel, middle="ELSE"))
-                exec_lines.extend(self._add_tail("WHILE", "END WHILE", function_indexed, start_line=rel))
-                exec_lines.extend(self._add_named_tail("WHILE", "END WHILE", function_indexed, start_line=rel))
-                exec_lines.extend(self._add_tail("LOOP", "END LOOP", function_indexed, start_line=rel))
-                exec_lines.extend(self._add_named_tail("LOOP", "END LOOP", function_indexed, start_line=rel))
-                exec_lines.extend(self._add_tail("CASE", "END CASE", function_indexed, start_line=rel, middle="WHEN"))
-                exec_lines.extend(self._add_named_tail("CASE", "END CASE", function_indexed, start_line=rel, middle="WHEN"))
-                exec_lines.extend(self._add_tail("REPEAT", "END REPEAT", function_indexed, start_line=rel))
-                exec_lines.extend(self._add_named_tail("REPEAT", "END REPEAT", function_indexed, start_line=rel))
-                exec_lines.extend(self._add_tail("FOR", "END FOR", function_indexed, start_line=rel))
-                exec_lines.extend(self._add_named_tail("FOR", "END FOR", function_indexed, start_line=rel))
-                exec_lines.extend(self._add_tail("BEGIN ATOMIC", "END", function_indexed, start_line=rel))
-                exec_lines.extend(self._add_named_tail("BEGIN ATOMIC", "END", function_indexed, start_line=rel))
-        return remove_duplicates_and_sort(exec_lines)
-
-    def _parse_indexed_line(self, s: str) -> Tuple[int, str]:
-        try:
-            num_str, content = s.split(":", 1)
-            return int(num_str.strip()), content.lstrip()
-        except Exception:
-            return -1, s
-
-    def _find_from_rel(self, function_indexed: List[str], start_line_num: int):
-        for s in function_indexed[start_line_num - 1:]:
-            n, content = self._parse_indexed_line(s)
-            yield n, content
+    def _collect_executed_lines_for(self, function: FunctionSource) -> Tuple[List[int], Dict[int, int], int]:
+        """Expand the traced hits of one function into the list of executed relative lines.
 
-    def _add_BEGIN_tail_and_header(self, stmt: str, function_indexed: List[str]) -> List[int]:
+        Each unique (function, line, statement) entry is expanded once; its hit count is
+        added to the returned relative line -> hits map. Also returns the number of entries.
+        """
+        exec_lines: List[int] = []
+        line_hits: Dict[int, int] = {}
+        entries = [entry
+                   for func_id in self._traced_function_ids(function.key)
+                   for entry in self._function_entries[func_id].items()]
+        if not entries:
+            return [], line_hits, 0
+        block_index = function.blocks or function_block_index(function.lines)
+        for (rel, stmt), hits in entries:
+            line_hits[rel] = line_hits.get(rel, 0) + hits
+            exec_lines.append(rel)
+            exec_lines.extend(self._add_BEGIN_tail_and_header(stmt, block_index))
+            exec_lines.extend(self._add_atomic_tail_and_header(stmt, block_index))
+            exec_lines.extend(block_index.tail_lines(rel))
+        return remove_duplicates_and_sort(exec_lines), line_hits, len(entries)
+
+    def _add_BEGIN_tail_and_header(self, stmt: str, block_index: BlockIndex) -> List[int]:
         out = []
-        if re.match(r"^BEGIN\b.*\bEND\b", stmt, flags=re.IGNORECASE):
+        if RE_BEGIN_END_STMT.match(stmt):
             out.append(1)
-            for s in reversed(function_indexed):
-                n, content = self._parse_indexed_line(s)
-                if re.search(r"^END\s*;", content, flags=re.IGNORECASE):
-                    out.append(n)
-                    break
-        return out
-
-    def _add_atomic_tail_and_header(self, stmt: str, function_indexed: List[str]) -> List[int]:
-        out = []
-        m = re.match(r"^(.*)\s*:\s*.*ATOMIC.*END", stmt, flags=re.IGNORECASE)
-        if m:
-            label = m.group(1).strip()
-            for s in reversed(function_indexed):
-                n, content = self._parse_indexed_line(s)
-                if re.search(rf"^END\s+{re.escape(label)}\s*;", content, flags=re.IGNORECASE):
-                    out.append(n)
-                    break
-        return out
-
-    def _add_tail(self, begin: str, end: str, function_indexed: List[str], *, start_line: int, middle: str = "") -> List[int]:
-        out = []
-        tag_counter = 0
-        in_block_comment = False
-        begin_re = re.compile(rf"^{begin}\b", re.IGNORECASE)
-        end_re = re.compile(rf"^{end}\s*;", re.IGNORECASE)
-        middle_re = re.compile(rf"^{middle}\b", re.IGNORECASE) if middle else None
-        for n, content in self._find_from_rel(function_indexed, start_line):
-            if self.re_comment_line.search(f"{n}: {content}"):
-                continue
-            if not in_block_comment and self.re_block_comment_start.search(f"{n}: {content}"):
-                in_block_comment = True
-            if in_block_comment:
-                if self.re_block_comment_end_anywhere.search(content):
-                    in_block_comment = False
-                continue
-            if begin_re.search(content):
-                tag_counter += 1
-                continue
-            if middle_re and middle_re.search(content) and tag_counter == 1:
+            n = block_index.last_end_line()
+            if n:
                 out.append(n)
-                continue
-            if end_re.search(content):
-                tag_counter -= 1
-                if tag_counter == 0:
-                    out.append(n)
-                    break
         return out
 
-    def _add_named_tail(self, begin: str, end: str, function_indexed: List[str], *, start_line: int, middle: str = "") -> List[int]:
+    def _add_atomic_tail_and_header(self, stmt: str, block_index: BlockIndex) -> List[int]:
         out = []
-        try:
-            start_line_text = function_indexed[start_line - 1].split(":", 1)[1].strip()
-        except Exception:
-            start_line_text = ""
-        m = re.match(r"^(\w+)\s*:\s*" + re.escape(begin), start_line_text, re.IGNORECASE)
-        if not m:
-            return out
-        label = m.group(1)
-        tag_counter = 0
-        in_block_comment = False
-        begin_re = re.compile(rf"^{re.escape(label)}\s*:\s*{begin}\b", re.IGNORECASE)
-        end_re = re.compile(rf"^{end}\s+{re.escape(label)}\s*;", re.IGNORECASE)
-        middle_re = re.compile(rf"^{middle}\b", re.IGNORECASE) if middle else None
-
-        for n, content in self._find_from_rel(function_indexed, start_line):
-            if self.re_comment_line.search(f"{n}: {content}"):
-                continue
-            if not in_block_comment and self.re_block_comment_start.search(f"{n}: {content}"):
-                in_block_comment = True
-            if in_block_comment:
-                if self.re_block_comment_end_anywhere.search(content):
-                    in_block_comment = False
-                continue
-            if begin_re.search(content):
-                tag_counter += 1
-                continue
-            if middle_re and middle_re.search(content) and tag_counter == 1:
+        m = RE_ATOMIC_STMT.match(stmt)
+        if m:
+            n = block_index.last_labelled_end_line(m.group(1).strip())
+            if n:
                 out.append(n)
-                continue
-            if end_re.search(content):
-                tag_counter -= 1
-                if tag_counter == 0:
-                    out.append(n)
-                    break
         return out
 
-    def _calculate_and_store_function_indicator(self, esql_key: str, function_indexed: List[str], executed_lines: List[int]):
+    def _calculate_and_store_function_indicator(self, function: FunctionSource, executed_lines: List[int],
+                                                line_hits: Dict[int, int] | None = None):
         rendered: List[str] = []
-        rendered.append(f"\nESQL Function / Procedure {self.function_counter}: '{esql_key}'\n\n")
+        line_hits = line_hits or {}
+
+        def executed_marker(n: int) -> str:
+            if self.show_hit_counts and n in line_hits:
+                return f"[x] (hits: {line_hits[n]}) "
+            return "[x] "
+
         function_executable_lines = 0
         function_non_executable_lines = 0
         function_comment_lines = 0
 
         exec_set = set(executed_lines)
 
-        many_lines_comment = False
         current_cmd_not_finished = False
         current_cmd_is_case = False
 
@@ -419,41 +2264,34 @@ class ESQLCoverageEvaluator:
         executable_rel: Set[int] = set()
         executed_rel: Set[int] = set()
 
-        for s in function_indexed:
-            n, content = self._parse_indexed_line(s)
-            is_comment_line = content.strip().startswith("--")
-            is_blank_line = (content.strip() == "")
-            is_block_comment_start = content.strip().startswith("/*")
-            is_block_comment_end = content.strip().endswith("*/")
+        for n, text, info in zip(function.numbers, function.text, function.lines):
+            s = f"{n}: {text}"
+            code = info.code.rstrip()
 
-            if many_lines_comment:
+            if info.in_comment and not info.has_code:
+                # Inside a multi-line comment, even if the trace points at it
                 rendered.append(" " + s)
                 function_comment_lines += 1
-                if is_block_comment_end:
-                    many_lines_comment = False
                 continue
 
             if current_cmd_not_finished:
-                if is_comment_line or is_blank_line or is_block_comment_start:
+                if not info.has_code:
                     rendered.append(" " + s)
-                    if is_comment_line or is_block_comment_start:
+                    if info.has_comment:
                         function_comment_lines += 1
-                        if is_block_comment_start and not is_block_comment_end:
-                            many_lines_comment = True
                     else:
                         function_non_executable_lines += 1
                 else:
-                    rendered.append("[x] " + s)
+                    rendered.append(executed_marker(n) + s)
                     function_executable_lines += 1
                     executable_rel.add(n)
                     executed_rel.add(n)
                     ended = False
-                    stripped = content.rstrip()
                     if current_cmd_is_case:
-                        if stripped.endswith(";"):
+                        if code.endswith(";"):
                             ended = True
                     else:
-                        if stripped.endswith(";") or re.search(r"\b(THEN|DO|BEGIN)\b$", stripped, re.IGNORECASE):
+                        if code.endswith(";") or RE_CONTINUATION_COMPLETE.search(code):
                             ended = True
                     if ended:
                         current_cmd_not_finished = False
@@ -461,31 +2299,24 @@ class ESQLCoverageEvaluator:
                 continue
 
             if n in exec_set:
-                rendered.append("[x] " + s)
+                rendered.append(executed_marker(n) + s)
                 function_executable_lines += 1
                 executable_rel.add(n)
                 executed_rel.add(n)
-                core = s
-                dashdash = core.find("--")
-                if dashdash > 0:
-                    core = core[:dashdash]
-                core_content = core.split(":", 1)[1].rstrip() if ":" in core else core
-                if not re.search(r";\s*$|\b(THEN|ELSE|BEGIN|DO)\s*$", core_content, re.IGNORECASE):
+                if not RE_STMT_COMPLETE.search(code):
                     current_cmd_not_finished = True
-                    if re.search(r"\bCASE\b", core_content, re.IGNORECASE):
+                    if RE_CASE.search(code):
                         current_cmd_is_case = True
                 continue
 
-            if not is_comment_line and not is_blank_line and not is_block_comment_start and not content.strip().startswith("&#xd;"):
+            if info.has_code:
                 rendered.append("[ ] " + s)
                 function_executable_lines += 1
                 executable_rel.add(n)
             else:
                 rendered.append(" " + s)
-                if is_comment_line or is_block_comment_start:
+                if info.has_comment:
                     function_comment_lines += 1
-                    if is_block_comment_start and not is_block_comment_end:
-                        many_lines_comment = True
                 else:
                     function_non_executable_lines += 1
 
@@ -497,52 +2328,88 @@ class ESQLCoverageEvaluator:
     # Phase 4: Write reports
     # -------------------------
     def write_report(self) -> None:
-        from datetime import datetime
-        now = datetime.now()
-        with self.report_file.open("w", encoding="utf-8") as f:
-            f.write(f"ESQL Source Code: {self.esql_source}\n")
-            f.write(f"User Trace Log : {self.trace_log}\n")
-            f.write(f"Execution time : {now:%Y-%m-%d %H:%M:%S}\n\n")
-            f.write("IAM2 version : 1.0.6\n")
-            f.write("-------------------------\n")
-            f.write("Overview of Code Coverage\n")
-            f.write("-------------------------\n")
-            total_functions = self.function_counter
-            f.write(f"Total Functions & Procedures: {total_functions}\n\n")
-
-            total_executed = 0
-            total_executable = 0
-            for function in sorted(self.esql_module_func_stats.keys(), key=str.lower):
-                executed, executable, nonexec, comments = self.esql_module_func_stats[function]
-                total_lines = executable + nonexec + comments
-                if executable > 0:
-                    code_coverage = f"{(executed / executable) * 100:5.1f}"
-                    percent_comment = f"{(comments / (executable + comments) * 100):5.1f}" if (executable + comments) > 0 else "  0.0"
-                else:
-                    code_coverage = "  0.0"
-                    percent_comment = "  0.0"
-                f.write(f"'{function}'\n")
-                f.write(f"Lines : {total_lines} ({comments} comment and {nonexec} blank lines)\n")
-                f.write(f"Executed Lines : {executed} of {executable} executable lines\n")
-                f.write(f"Percent comment : {percent_comment}%\n")
-                f.write(f"Code coverage : {code_coverage}%\n\n")
-                total_executed += executed
-                total_executable += executable
-
-            total_coverage = (total_executed / total_executable * 100) if total_executable > 0 else 0.0
-            f.write(f"Total Executed Lines : {total_executed} of {total_executable} executable lines\n")
-            f.write(f"Total Code Coverage : {total_coverage:.1f}%\n\n")
-            f.write("------------------------\n")
-            f.write("Details of Code Coverage\n")
-            f.write("------------------------\n")
-            f.write("[x] line was executed\n")
-            f.write("[ ] line was not executed\n")
-            f.write(" line is comment or blank line\n")
-            for line in self.result_lines:
-                f.write(line + ("" if line.endswith("\n") else "\n"))
+        """Stream the text report (and the SonarQube XML and snapshot, if requested) to disk.
+
+        The overview comes from the per-function stats of phase 3; the details are rendered
+        again one function at a time, so only the largest function is held in memory.
+        """
+        if self.report_file is not None:
+            with self.report_file.open("w", encoding="utf-8", buffering=REPORT_WRITE_BUFFER_SIZE) as f:
+                f.writelines(self._iter_report_overview())
+                f.writelines(self._iter_report_details())
 
         if self.sonar_coverage_xml:
             self._write_sonar_generic_coverage(self.sonar_coverage_xml)
+        if self.snapshot_file:
+            self._write_snapshot(self.snapshot_file)
+
+    def _write_snapshot(self, out_path: Path) -> None:
+        """Write the executed lines and hit counts of all traced functions as a CoverageSnapshot."""
+        snapshot = CoverageSnapshot()
+        for source, result in zip(self.esql_sources, self._source_coverage):
+            name = self._source_name(source)
+            snapshot.add_source(name, file_digest(source))
+            for function_source, function in zip(result.functions, result.coverage):
+                if function.executed:
+                    snapshot.add_function(name, function_source.body_start, function.key,
+                                          function.executed, function.line_hits)
+        snapshot.write(out_path)
+
+    def _iter_report_overview(self) -> Iterator[str]:
+        now = datetime.now()
+        yield f"ESQL Source Code: {self.esql_source}\n"
+        if self.project_mode:
+            yield f"ESQL Source Files : {len(self.esql_sources)}\n"
+        if self.snapshots:
+            yield f"Coverage Snapshots : {len(self.snapshots)}\n"
+        else:
+            yield f"User Trace Log : {', '.join(str(p) for p in self.trace_logs)}\n"
+        yield f"Execution time : {now:%Y-%m-%d %H:%M:%S}\n\n"
+        yield "IAM2 version : 1.0.6\n"
+        yield "-------------------------\n"
+        yield "Overview of Code Coverage\n"
+        yield "-------------------------\n"
+        total_functions = self.function_counter
+        yield f"Total Functions & Procedures: {total_functions}\n\n"
+
+        total_executed = 0
+        total_executable = 0
+        for function in sorted(self.esql_module_func_stats.keys(), key=str.lower):
+            executed, executable, nonexec, comments = self.esql_module_func_stats[function]
+            total_lines = executable + nonexec + comments
+            if executable > 0:
+                code_coverage = f"{(executed / executable) * 100:5.1f}"
+                percent_comment = f"{(comments / (executable + comments) * 100):5.1f}" if (executable + comments) > 0 else "  0.0"
+            else:
+                code_coverage = "  0.0"
+                percent_comment = "  0.0"
+            yield f"'{function}'\n"
+            yield f"Lines : {total_lines} ({comments} comment and {nonexec} blank lines)\n"
+            yield f"Executed Lines : {executed} of {executable} executable lines\n"
+            yield f"Percent comment : {percent_comment}%\n"
+            yield f"Code coverage : {code_coverage}%\n\n"
+            total_executed += executed
+            total_executable += executable
+
+        total_coverage = (total_executed / total_executable * 100) if total_executable > 0 else 0.0
+        yield f"Total Executed Lines : {total_executed} of {total_executable} executable lines\n"
+        yield f"Total Code Coverage : {total_coverage:.1f}%\n\n"
+
+    def _iter_report_details(self) -> Iterator[str]:
+        yield "------------------------\n"
+        yield "Details of Code Coverage\n"
+        yield "------------------------\n"
+        yield "[x] line was executed\n"
+        yield "[ ] line was not executed\n"
+        yield " line is comment or blank line\n"
+        if self.show_hit_counts:
+            yield "(hits: n) number of times the statement on this line was traced\n"
+        for number, label, function_source, function in self._report_sections:
+            yield f"\nESQL Function / Procedure {number}: '{label}'\n\n"
+            _, rendered, _, _ = self._calculate_and_store_function_indicator(
+                function_source, function.executed, function.line_hits)
+            for line in rendered:
+                yield line + "\n"
 
     def _write_sonar_generic_coverage(self, out_path: Path) -> None:
         """Write SonarQube Generic Test Coverage XML (coverage version=1).
@@ -550,16 +2417,19 @@ class ESQLCoverageEvaluator:
         """
         out_path = Path(out_path)
         out_path.parent.mkdir(parents=True, exist_ok=True)
-        lines = []
-        lines.append('<coverage version="1">')
+        with out_path.open("w", encoding="utf-8", buffering=REPORT_WRITE_BUFFER_SIZE) as f:
+            f.writelines(self._iter_sonar_generic_coverage())
+
+    def _iter_sonar_generic_coverage(self) -> Iterator[str]:
+        yield '<coverage version="1">\n'
         for file_path in sorted(self.sonar_coverage_map.keys()):
-            lines.append(f'  <file path="{self._xml_escape(file_path)}">')
-            for ln in sorted(self.sonar_coverage_map[file_path].keys()):
-                covered = 'true' if self.sonar_coverage_map[file_path][ln] else 'false'
-                lines.append(f'    <lineToCover lineNumber="{ln}" covered="{covered}"/>')
-            lines.append('  </file>')
-        lines.append('</coverage>')
-        out_path.write_text("\n".join(lines) + "\n", encoding='utf-8')
+            file_map = self.sonar_coverage_map[file_path]
+            yield f'  <file path="{self._xml_escape(file_path)}">\n'
+            for ln in sorted(file_map.keys()):
+                covered = 'true' if file_map[ln] else 'false'
+                yield f'    <lineToCover lineNumber="{ln}" covered="{covered}"/>\n'
+            yield '  </file>\n'
+        yield '</coverage>\n'
 
     @staticmethod
     def _xml_escape(text: str) -> str:
@@ -569,14 +2439,536 @@ class ESQLCoverageEvaluator:
                     .replace('<', '&lt;')
                     .replace('>', '&gt;'))
 
+    def _refresh_functions(self, traced_function_ids: Set[int]) -> None:
+        """Evaluate again the functions that match one of the given traced functions."""
+        for result in self._source_coverage:
+            for i, function in enumerate(result.functions):
+                if self._traced_function_ids(function.key, traced_function_ids):
+                    result.coverage[i] = self._evaluate_function(function)
+        self._store_coverage()
+
+    # -------------------------
+    # Test impact map
+    # -------------------------
+    def _test_case_hits(self) -> Dict[str, Dict[Tuple[str, int, str], int]]:
+        """Stream the traces once, in order, and count the hits of each test case.
+
+        A record belongs to the test named by the latest line matching test_markers (its
+        'test' group, else group 1, else the whole match), or to every test whose time window
+        contains its timestamp (tests run in parallel overlap). Records outside any test are ignored.
+        """
+        known_schema_modules = frozenset(self.esql_schema_modules)
+        parse = self.trace_parser.parse
+        markers = self.test_markers
+        windows = self.test_windows
+        starts = [start for _, start, _ in windows]
+        # Latest end of the windows up to each one: the backward scan stops below the stamp
+        max_ends: List[str] = []
+        for _, _, end in windows:
+            max_ends.append(max(end, max_ends[-1]) if max_ends else end)
+        tests: Dict[str, Dict[Tuple[str, int, str], int]] = {name: {} for name, _, _ in windows}
+        current: List[Dict[Tuple[str, int, str], int]] = []
+        # A marker holds until the next one, so also across files given out of time order
+        for trace_log in sort_traces_by_time(self.trace_logs):
+            for line in iter_text_lines(trace_log):
+                if markers is not None:
+                    m = markers.search(line)
+                    if m:
+                        groups = m.groupdict()
+                        name = (groups.get("test") or (m.group(1) if m.lastindex else None) or m.group()).strip()
+                        current = [tests.setdefault(name, {})]
+                        continue
+                elif line[:4].isdigit():
+                    stamp = record_time(line)
+                    current = []
+                    if stamp is None:
+                        continue
+                    i = bisect_right(starts, stamp) - 1
+                    while i >= 0 and max_ends[i] > stamp:
+                        if stamp < windows[i][2]:
+                            current.append(tests[windows[i][0]])
+                        i -= 1
+                if not current:
+                    continue
+                hit = parse(line)
+                if hit is not None and self._is_known_function(hit[0], known_schema_modules):
+                    for test in current:
+                        test[hit] = test.get(hit, 0) + 1
+        return tests
+
+    def write_impact_map(self, out_path: Path) -> None:
+        """Write which tests cover which executable source lines (JSON; absolute file lines).
+
+        Every executable line of an evaluated function is listed, uncovered ones with no tests.
+        """
+        all_entries = self.extracted_log_entries
+        tests = self._test_case_hits()
+        names = [self._source_name(source) for source in self.esql_sources]
+        sources: Dict[str, Dict[int, List[int]]] = {name: {} for name in names}
+        for name, result in zip(names, self._source_coverage):
+            for function in result.coverage:
+                for abs_line in function.coverage:
+                    sources[name].setdefault(abs_line, [])
+        try:
+            for test_number, hits in enumerate(tests.values()):
+                self.extracted_log_entries = hits
+                self._build_entry_index()
+                for name, model in zip(names, self._source_models):
+                    for function in model.functions:
+                        if not self._traced_function_ids(function.key):
+                            continue
+                        for abs_line, covered in self._evaluate_function(function).coverage.items():
+                            if covered:
+                                sources[name].setdefault(abs_line, []).append(test_number)
+        finally:
+            self.extracted_log_entries = all_entries
+            self._build_entry_index()
+        if self.stats is not None:
+            self.stats.set("tests", len(tests))
+        impact_map = {
+            "version": IMPACT_MAP_VERSION,
+            "tests": list(tests),
+            "sources": {name: {str(n): lines[n] for n in sorted(lines)} for name, lines in sources.items()},
+        }
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        out_path.write_text(json.dumps(impact_map, separators=(",", ":")) + "\n", encoding="utf-8")
+
+    # -------------------------
+    # Trace slices: message listing and message types
+    # -------------------------
+    def iter_message_list(self) -> Iterator[str]:
+        """One line per message of the traces, numbered as --message expects."""
+        number = 1
+        yield f"{'Message':>7}  {'Thread':>8}  {'Received':<26}  Input node\n"
+        for trace_log in self.trace_logs:
+            index = self._trace_index(trace_log)
+            yield f"# {trace_log}\n"
+            for thread, node, received in zip(index.message_threads, index.message_nodes, index.message_times):
+                yield f"{number:>7}  {index.threads[thread]:>8}  {received:<26}  {index.nodes[node]}\n"
+                number += 1
+
+    def write_message_types(self, out_path: Path) -> None:
+        """Write the traced functions, with their statements and hits, per message type (input node).
+
+        The other slice options (threads, time window) still apply.
+        """
+        known_schema_modules = frozenset(self.esql_schema_modules)
+        base = self.trace_slice or TraceSlice()
+        nodes = sorted({node for trace_log in self.trace_logs for node in self._trace_index(trace_log).nodes})
+        with out_path.open("w", encoding="utf-8", buffering=REPORT_WRITE_BUFFER_SIZE) as f:
+            for node in nodes:
+                node_slice = base._replace(messages=frozenset(), nodes=frozenset([node]))
+                message_count = sum(len(self._trace_index(t).messages_of_nodes(node_slice.nodes))
+                                    for t in self.trace_logs)
+                hits: Dict[Tuple[str, int, str], int] = {}
+                for partial in self._run_trace_tasks(self._plan_slice_tasks(node_slice), known_schema_modules):
+                    for key, count in partial.items():
+                        hits[key] = hits.get(key, 0) + count
+                # traced function -> [unique statements, hits]
+                functions: Dict[str, List[int]] = {}
+                for (func, _, _), count in hits.items():
+                    totals = functions.setdefault(func, [0, 0])
+                    totals[0] += 1
+                    totals[1] += count
+                f.write(f"Message type (input node): '{node}'\n")
+                f.write(f"Messages : {message_count}\n")
+                for func in sorted(functions, key=str.lower):
+                    statements, hits = functions[func]
+                    f.write(f"  '{func}' : {statements} statements, {hits} hits\n")
+                f.write("\n")
+
+    def coverage_summary(self) -> dict:
+        """Coverage per function and per source file line, as returned by the coverage server."""
+        functions = []
+        for label in sorted(self.esql_module_func_stats, key=str.lower):
+            executed, executable, nonexec, comments = self.esql_module_func_stats[label]
+            functions.append({"name": label, "executed": executed, "executable": executable,
+                              "comment_lines": comments, "blank_lines": nonexec})
+        total_executed = sum(f["executed"] for f in functions)
+        total_executable = sum(f["executable"] for f in functions)
+        return {
+            "functions": functions,
+            "total_functions": self.function_counter,
+            "executed": total_executed,
+            "executable": total_executable,
+            "coverage": round(total_executed / total_executable * 100, 1) if total_executable else 0.0,
+            "files": {path: {"covered": [n for n in sorted(lines) if lines[n]],
+                             "uncovered": [n for n in sorted(lines) if not lines[n]]}
+                      for path, lines in sorted(self.sonar_coverage_map.items())},
+        }
+
     # -------------------------
     # Public API
     # -------------------------
-    def run(self) -> None:
+    def prepare(self) -> None:
+        """Phase 1 for an evaluator kept in memory (see fork): sources parsed with their block indexes."""
         self._discover_schema_modules()
+        self._source_models = [model._replace(functions=[
+            f if f.blocks is not None else f._replace(blocks=function_block_index(f.lines))
+            for f in model.functions]) for model in self._source_models]
+
+    def fork(self, trace_logs: Sequence[Path], show_hit_counts: bool = False) -> "ESQLCoverageEvaluator":
+        """Evaluator for other traces sharing this one's parsed sources, filters and trace pattern.
+
+        The copy continues at phase 2 (see evaluate) and writes no files; this evaluator is
+        not modified, so several forks may be evaluated at the same time.
+        """
+        # Not copy.copy: __getstate__ leaves out the parsed sources (they are sent to workers separately)
+        other = object.__new__(type(self))
+        other.__dict__.update(self.__dict__)
+        other._reset_run_state()
+        other.trace_logs = list(trace_logs)
+        other.trace_log = other.trace_logs[0] if other.trace_logs else None
+        other.show_hit_counts = show_hit_counts
+        other.report_file = other.sonar_coverage_xml = other.snapshot_file = None
+        other.message_types_file = other.impact_map_file = other.results_file = None
+        other.store = None
+        other.snapshots = []
+        other._snapshot = None
+        other.stats = None
+        other.phase_hooks = []
+        other._trace_indexes = {}
+        return other
+
+    def evaluate(self) -> None:
+        """Phases 2 and 3 for an evaluator whose sources are already parsed."""
         self._extract_from_log()
         self._process_esql()
-        self.write_report()
+
+    def run(self) -> None:
+        with self._phase("discover"):
+            self._discover_schema_modules()
+        with self._phase("extract"):
+            if self.snapshots:
+                self._load_snapshots()
+            else:
+                self._extract_from_log()
+        with self._phase("process"):
+            self._process_esql()
+        with self._phase("report"):
+            self.write_report()
+            if self.message_types_file is not None:
+                self.write_message_types(self.message_types_file)
+        if self.impact_map_file is not None:
+            with self._phase("impact"):
+                self.write_impact_map(self.impact_map_file)
+
+    def follow(self, interval: float, trace_specs: List[str] | None = None) -> None:
+        """Tail the traces and rewrite the reports every interval seconds until interrupted.
+
+        trace_specs (files or globs) are expanded again on every refresh, so traces created by
+        rotation are picked up. A refresh parses only the new trace lines and evaluates only
+        the functions they hit.
+        """
+        with self._phase("discover"):
+            self._discover_schema_modules()
+        known_schema_modules = frozenset(self.esql_schema_modules)
+        # Without --store the checkpoints only live as long as this process
+        with CoverageStore(self.store if self.store is not None else Path(":memory:")) as store:
+            with self._phase("extract"):
+                store.reset_if_changed(self.trace_pattern.pattern)
+                self._read_new_trace_hits(store, following=True)
+                self._merge_hits({key: count for key, count in store.load_hits()
+                                  if self._is_known_function(key[0], known_schema_modules)})
+                self._build_entry_index()
+            with self._phase("process"):
+                self._process_esql()
+            with self._phase("report"):
+                self.write_report()
+            while True:
+                time.sleep(interval)
+                if trace_specs:
+                    try:
+                        self.trace_logs = expand_trace_paths(trace_specs)
+                    except FileNotFoundError:
+                        pass  # glob matches nothing mid-rotation; keep the previous files
+                new_hits = {key: count for key, count in self._read_new_trace_hits(store, following=True).items()
+                            if self._is_known_function(key[0], known_schema_modules)}
+                if not new_hits:
+                    continue
+                self._merge_hits(new_hits)
+                self._refresh_functions(self._index_hits(new_hits))
+                self.write_report()
+                print(f"{time.strftime('%H:%M:%S')} report refreshed ({sum(new_hits.values())} new trace hits)")
+
+
+# Evaluator shared with the project-mode worker processes
+_source_worker_evaluator: ESQLCoverageEvaluator | None = None
+
+
+# Source models of the function workers (the evaluator is pickled without them)
+_source_worker_models: List[SourceModel] = []
+
+
+def _init_source_worker(evaluator: ESQLCoverageEvaluator | None = None,
+                        models: List[SourceModel] | None = None) -> None:
+    global _source_worker_evaluator, _source_worker_models
+    _source_worker_evaluator = evaluator
+    _source_worker_models = models or []
+
+
+def _load_source_model_worker(source: Path) -> SourceModel:
+    return _source_worker_evaluator._load_source_model(source)
+
+
+def _evaluate_source_worker(model: SourceModel) -> List[FunctionCoverage]:
+    return _source_worker_evaluator._evaluate_source(model)
+
+
+def _evaluate_functions_worker(batch: Tuple[int, int, int]) -> List[FunctionCoverage]:
+    index, first, end = batch
+    functions = _source_worker_models[index].functions[first:end]
+    return [_source_worker_evaluator._evaluate_function(function) for function in functions]
+
+
+# -----------------------------
+# Coverage server (serve)
+# -----------------------------
+
+SERVER_FORMATS = ("json", "report", "sonar")
+DEFAULT_SERVER_PORT = 8765
+# Chunk size used when spooling uploaded trace bodies to disk
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+def source_signature(paths: Sequence[Path]) -> Tuple[Tuple[str, int, int], ...]:
+    """(path, mtime, size) of files a parsed project depends on; a change means parsing again."""
+    out = []
+    for path in paths:
+        try:
+            st = path.stat()
+            out.append((str(path), st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            out.append((str(path), 0, -1))
+    return tuple(out)
+
+
+class ProjectCache:
+    """Prepared evaluators (sources parsed, pattern compiled) per project, least recently used evicted.
+
+    A project is a source file or directory plus the pattern, filter files and trace parser.
+    Changed sources, added or removed project files and edited filter/pattern files are
+    noticed by their signature, and the project is prepared again.
+    """
+
+    def __init__(self, max_projects: int, workers: int = 1, cache_dir: Path | None = None,
+                 cache_size: int = DEFAULT_SOURCE_CACHE_SIZE):
+        self.max_projects = max_projects
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self._projects: "OrderedDict[tuple, Tuple[tuple, ESQLCoverageEvaluator]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # One lock per project, so a project is prepared once however many requests wait for it
+        self._project_locks: Dict[tuple, threading.Lock] = {}
+
+    def __len__(self) -> int:
+        return len(self._projects)
+
+    def get(self, source: Path, pattern: Path, filter_modules: Path, filter_funcs: Path,
+            parser: str) -> ESQLCoverageEvaluator:
+        source = source.resolve()
+        key = (str(source), str(pattern.resolve()), str(filter_modules.resolve()), str(filter_funcs.resolve()), parser)
+        with self._lock:
+            project_lock = self._project_locks.setdefault(key, threading.Lock())
+        with project_lock:
+            sources = find_esql_sources(source) if source.is_dir() else [source]
+            signature = source_signature(sources + [pattern, filter_modules, filter_funcs])
+            with self._lock:
+                entry = self._projects.get(key)
+                if entry is not None and entry[0] == signature:
+                    self._projects.move_to_end(key)
+                    return entry[1]
+            try:
+                evaluator = ESQLCoverageEvaluator(
+                    [], source, None, pattern_file=pattern, filter_modules_file=filter_modules,
+                    filter_funcs_file=filter_funcs, parser=parser, workers=self.workers,
+                    cache_dir=self.cache_dir, cache_size=self.cache_size)
+                evaluator.prepare()
+                with self._lock:
+                    self._projects[key] = (signature, evaluator)
+                    self._projects.move_to_end(key)
+                    while len(self._projects) > self.max_projects:
+                        evicted, _ = self._projects.popitem(last=False)
+                        self._project_locks.pop(evicted, None)
+                return evaluator
+            finally:
+                # A project that failed to prepare (e.g. a missing source) keeps no lock behind
+                with self._lock:
+                    if key not in self._projects and self._project_locks.get(key) is project_lock:
+                        del self._project_locks[key]
+
+
+class CoverageRequestHandler(BaseHTTPRequestHandler):
+    """HTTP API of the coverage server.
+
+    GET  /health    -> {"status": "ok", "projects": <prepared projects>}
+    POST /evaluate  -> coverage of traces on the server's disk (JSON body {"source": ...,
+                       "traces": [...]}) or of a trace sent as the request body (other content
+                       types, parameters in the query string). Options: format (json, report,
+                       sonar), hit_counts, parser, pattern, filter_modules, filter_funcs.
+    """
+
+    server_version = "IAM2Coverage/1.0"
+
+    def do_GET(self) -> None:
+        if urlsplit(self.path).path != "/health":
+            self._send_json(404, {"error": f"unknown path: {self.path}"})
+            return
+        self._send_json(200, {"status": "ok", "projects": len(self.server.projects)})
+
+    def do_POST(self) -> None:
+        if urlsplit(self.path).path != "/evaluate":
+            self._send_json(404, {"error": f"unknown path: {self.path}"})
+            return
+        started = time.perf_counter()
+        upload = None
+        try:
+            params = {k: v[-1] for k, v in parse_qs(urlsplit(self.path).query).items()}
+            length = self.headers.get("Content-Length")
+            if length is None:
+                self._send_json(411, {"error": "Content-Length required"})
+                return
+            length = int(length)
+            if self.headers.get_content_type() == "application/json":
+                body = json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+                if not isinstance(body, dict):
+                    raise ValueError("JSON body must be an object")
+                params.update(body)
+                traces = params.get("traces") or []
+                if isinstance(traces, str):
+                    traces = [traces]
+                if not isinstance(traces, list) or not all(isinstance(t, str) for t in traces):
+                    raise ValueError("'traces' must be a path or a list of paths")
+                trace_logs = expand_trace_paths(traces)
+            else:
+                upload = self._spool_body(length)
+                trace_logs = [Path(upload.name)]
+            # JSON bodies may give any parameter any type; check them all before evaluating
+            source = self._str_param(params, "source")
+            if source is None:
+                raise ValueError("'source' (a path) is required")
+            out_format = self._str_param(params, "format", "json")
+            if out_format not in SERVER_FORMATS:
+                raise ValueError(f"unknown format '{out_format}', expected one of {', '.join(SERVER_FORMATS)}")
+            defaults = self.server.defaults
+            parser = self._str_param(params, "parser", defaults["parser"])
+            if parser not in TRACE_PARSERS:
+                raise ValueError(f"unknown parser '{parser}', expected one of {', '.join(TRACE_PARSERS)}")
+            hit_counts = params.get("hit_counts", "")
+            if not isinstance(hit_counts, (str, bool, int)):
+                raise ValueError("'hit_counts' must be a boolean")
+            project = self.server.projects.get(
+                Path(source),
+                Path(self._str_param(params, "pattern", defaults["pattern"])),
+                Path(self._str_param(params, "filter_modules", defaults["filter_modules"])),
+                Path(self._str_param(params, "filter_funcs", defaults["filter_funcs"])),
+                parser)
+            hit_counts = str(hit_counts).lower() in ("1", "true", "yes")
+            evaluator = project.fork(trace_logs, show_hit_counts=hit_counts)
+            evaluator.evaluate()
+        except (FileNotFoundError, ValueError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            raise
+        finally:
+            if upload is not None:
+                upload.close()
+        if out_format == "json":
+            result = evaluator.coverage_summary()
+            result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            self._send_json(200, result)
+        elif out_format == "report":
+            self._send_lines("text/plain", chain(evaluator._iter_report_overview(), evaluator._iter_report_details()))
+        else:
+            self._send_lines("application/xml", evaluator._iter_sonar_generic_coverage())
+
+    @staticmethod
+    def _str_param(params: dict, name: str, default: str | Path | None = None) -> str | Path | None:
+        """A text parameter of the request (query string or JSON body); default if missing or empty."""
+        value = params.get(name)
+        if value is None or value == "":
+            return default
+        if not isinstance(value, str):
+            raise ValueError(f"'{name}' must be a string")
+        return value
+
+    def _spool_body(self, length: int):
+        """Copy the request body (a plain or gzip/bz2/xz compressed trace) to a temporary file."""
+        upload = tempfile.NamedTemporaryFile(prefix="iam2-trace-", suffix=".txt")
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            upload.write(chunk)
+            remaining -= len(chunk)
+        upload.flush()
+        return upload
+
+    def _send_json(self, status: int, body: dict) -> None:
+        data = (json.dumps(body) + "\n").encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_lines(self, content_type: str, lines: Iterator[str]) -> None:
+        # HTTP/1.0 response without a length: the body ends when the connection is closed
+        self.send_response(200)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.end_headers()
+        out = io.TextIOWrapper(self.wfile, encoding="utf-8", write_through=False)
+        out.writelines(lines)
+        out.flush()
+        out.detach()
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format: str, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class _PooledServerMixIn:
+    """Handle requests on a bounded thread pool instead of one new thread per request."""
+
+    def init_pool(self, workers: int, projects: ProjectCache, defaults: dict, verbose: bool) -> None:
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.projects = projects
+        self.defaults = defaults
+        self.verbose = verbose
+
+    def process_request(self, request, client_address) -> None:
+        self.pool.submit(self._process_request_in_pool, request, client_address)
+
+    def _process_request_in_pool(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+class CoverageHTTPServer(_PooledServerMixIn, HTTPServer):
+    pass
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class CoverageUnixServer(_PooledServerMixIn, socketserver.UnixStreamServer):
+        pass
+else:
+    CoverageUnixServer = None
 
 
 # -----------------------------
@@ -584,32 +2976,286 @@ class ESQLCoverageEvaluator:
 # -----------------------------
 
 def main():
+    if sys.argv[1:2] == ["merge"]:
+        merge_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["impact"]:
+        sys.exit(impact_main(sys.argv[2:]))
+    if sys.argv[1:2] == ["serve"]:
+        serve_main(sys.argv[2:])
+        return
     parser = argparse.ArgumentParser(description="Evaluate ESQL code coverage from IBM Integration Bus/ACE user trace logs (Python port of IAM2 evaluator). Optionally writes SonarQube Generic Coverage XML.")
-    parser.add_argument("userTraceFile", type=Path, help="The trace file (UserTrace or ServiceTrace)")
-    parser.add_argument("sourceCodeFile", type=Path, help="The ESQL source/CMF file")
-    parser.add_argument("reportFileName", type=Path, help="Output text report")
+    parser.add_argument("userTraceFile", help="The trace file (UserTrace or ServiceTrace), or a glob such as 'integration_server.trace.*.txt'")
+    parser.add_argument("sourceCodeFile", type=Path, help="The ESQL source/CMF file, or a directory whose .esql/.cmf files are all evaluated into one report")
+    parser.add_argument("reportFileName", type=Path, nargs="?", default=None, help="Output text report (may be left out with --snapshot)")
     parser.add_argument("--pattern", type=Path, default=Path("tracelog.pattern"), help="Path to tracelog.pattern (required)")
     parser.add_argument("--filter-modules", type=Path, default=Path("filterModules.txt"), help="Optional file listing modules to filter out")
     parser.add_argument("--filter-funcs", type=Path, default=Path("filterFunctionProcedure.txt"), help="Optional file listing procedures/functions to filter out")
     parser.add_argument("--sonar-coverage-xml", type=Path, default=None, help="Optional path to write SonarQube Generic Test Coverage XML (coverage version=1)")
+    parser.add_argument("--hit-counts", action="store_true", help="Show how often each traced line was executed in the report details")
+    parser.add_argument("--trace", action="append", default=[], metavar="TRACE", help="Additional trace file or glob (repeatable); hits of all traces are merged")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes for parsing trace files/shards and evaluating project sources (default: one per CPU)")
+    parser.add_argument("--jobs", type=int, default=1, help="Worker processes evaluating the functions of the ESQL sources, e.g. of one large CMF file (default: 1, no pool)")
+    parser.add_argument("--shard-mb", type=int, default=DEFAULT_TRACE_SHARD_SIZE >> 20, help="Split traces larger than this many MB into byte ranges parsed in parallel (0 = never split)")
+    parser.add_argument("--parser", choices=TRACE_PARSERS, default="regex", help="Trace line parser: 'regex' applies tracelog.pattern to every line, 'fast' parses standard \"... at ('<func>', '<line>').\" lines by hand and falls back to the pattern for unusual layouts")
+    parser.add_argument("--follow", action="store_true", help="Keep tailing the trace(s), including files created by rotation, and rewrite the report(s) until interrupted")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between report refreshes with --follow (default: 5)")
+    parser.add_argument("--cache-dir", type=Path, default=None, help="Directory caching the parsed ESQL sources; unchanged sources are not parsed again")
+    parser.add_argument("--cache-mb", type=int, default=DEFAULT_SOURCE_CACHE_SIZE >> 20, help="Size limit of --cache-dir in MB; least recently used entries are evicted (default: 256)")
+    parser.add_argument("--stats", action="store_true", help="Print wall/CPU time, peak memory and counters per phase")
+    parser.add_argument("--stats-json", type=Path, default=None, metavar="FILE", help="Write the --stats metrics as JSON (implies --stats)")
+    parser.add_argument("--profile", choices=("discover", "extract", "process", "report", "impact"), default=None, help="Run cProfile around one phase")
+    parser.add_argument("--profile-out", type=Path, default=None, metavar="FILE", help="pstats output of --profile (default: <phase>.prof)")
+    parser.add_argument("--store", type=Path, default=None, metavar="FILE", help="SQLite coverage store: hits are accumulated across runs and each trace is only read from where the previous run stopped")
+    parser.add_argument("--snapshot", type=Path, default=None, metavar="FILE", help="Write a compact binary coverage snapshot; snapshots of several runs are combined with the 'merge' command")
+    parser.add_argument("--thread", action="append", default=[], metavar="ID", help="Only evaluate the records of this trace thread (repeatable)")
+    parser.add_argument("--message", action="append", type=int, default=[], metavar="N", help="Only evaluate message N as numbered by --list-messages (repeatable)")
+    parser.add_argument("--message-node", action="append", default=[], metavar="NODE", help="Only evaluate the messages received by this input node, i.e. one message type (repeatable)")
+    parser.add_argument("--since", type=trace_time_arg, default=None, metavar="TIME", help="Only evaluate records stamped at or after TIME, e.g. '2008-04-23 14:22:30'")
+    parser.add_argument("--until", type=trace_time_arg, default=None, metavar="TIME", help="Only evaluate records stamped before TIME")
+    parser.add_argument("--index-dir", type=Path, default=None, metavar="DIR", help="Keep the thread/message offset index of each trace here, so slices of an unchanged or grown trace need no full scan")
+    parser.add_argument("--list-messages", action="store_true", help="Print the messages of the trace(s) with thread, time and input node")
+    parser.add_argument("--message-types", type=Path, default=None, metavar="FILE", help="Write the traced functions and their hits per message type (input node)")
+    parser.add_argument("--impact-map", type=Path, default=None, metavar="FILE", help="Write a JSON map from source line to the test cases covering it (needs --test-markers or --test-times)")
+    parser.add_argument("--test-markers", default=None, metavar="REGEX", help="Trace lines matching REGEX start a test case, named by its 'test' group, else group 1, else the match")
+    parser.add_argument("--test-times", type=Path, default=None, metavar="FILE", help="Test cases as lines '<test><TAB><start><TAB><end>' (trace timestamps)")
+    parser.add_argument("--results", type=Path, default=None, metavar="FILE", help="Per-function results of the previous run; only functions whose source or hits changed are evaluated again, and the file is updated")
+    parser.add_argument("--diff", type=Path, default=None, metavar="FILE", help="Unified diff (e.g. 'git diff' output, '-' for stdin) whose added/modified lines are the changed lines")
+    parser.add_argument("--changed", action="append", default=[], metavar="SOURCE:LINES", help="Changed lines, e.g. 'flows/Transformation_Compute.esql:10-20,25'; SOURCE relative to the working directory or the git repository (repeatable)")
+    parser.add_argument("--changed-report", type=Path, default=None, metavar="FILE", help="Write the coverage of every changed executable line")
+    parser.add_argument("--fail-under", type=float, default=None, metavar="PCT", help="Exit with code 1 if the coverage of the changed lines is below PCT percent")
 
     args = parser.parse_args()
-
+    outputs = (args.snapshot, args.impact_map, args.changed_report, args.fail_under, args.results)
+    if args.reportFileName is None and not args.list_messages and all(o is None for o in outputs):
+        parser.error("reportFileName is required unless another output (--snapshot, --impact-map, "
+                     "--changed-report, ...) or --list-messages is given")
+    if args.impact_map is not None and (args.test_markers is None) == (args.test_times is None):
+        parser.error("--impact-map needs exactly one of --test-markers and --test-times")
+    if args.profile == "impact" and args.impact_map is None:
+        parser.error("--profile impact needs --impact-map (the impact phase only runs to write it)")
+    changed_lines: Dict[str, Set[int]] = {}
+    if args.diff is not None:
+        diff_lines = sys.stdin if str(args.diff) == "-" else iter_text_lines(args.diff)
+        changed_lines = parse_unified_diff(line.rstrip("\n") for line in diff_lines)
+    for spec in args.changed:
+        try:
+            source, lines = parse_line_spec(spec)
+        except ValueError as e:
+            parser.error(str(e))
+        changed_lines.setdefault(source, set()).update(lines)
+    if (args.changed_report or args.fail_under is not None) and args.diff is None and not args.changed:
+        parser.error("--changed-report and --fail-under need --diff or --changed")
+    trace_slice = None
+    if args.thread or args.message or args.message_node or args.since or args.until:
+        trace_slice = TraceSlice(frozenset(args.thread), frozenset(args.message), frozenset(args.message_node),
+                                 args.since, args.until)
+    if (trace_slice is not None or args.message_types) and (args.store or args.follow):
+        parser.error("trace slices and --message-types cannot be combined with --store or --follow")
+
+    phase_hooks: List[PhaseHook] = []
+    profile_hook = None
+    if args.profile:
+        profile_out = args.profile_out or Path(f"{args.profile}.prof")
+        profile_hook = profile_phase_hook(args.profile, profile_out)
+        phase_hooks.append(profile_hook)
     evaluator = ESQLCoverageEvaluator(
-        trace_log=args.userTraceFile,
+        trace_log=expand_trace_paths([args.userTraceFile] + args.trace),
         esql_source=args.sourceCodeFile,
         report_file=args.reportFileName,
         pattern_file=args.pattern,
         filter_modules_file=args.filter_modules,
         filter_funcs_file=args.filter_funcs,
         sonar_coverage_xml=args.sonar_coverage_xml,
+        show_hit_counts=args.hit_counts,
+        parser=args.parser,
+        workers=args.workers,
+        jobs=args.jobs,
+        shard_size=args.shard_mb << 20,
+        store=args.store,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_mb << 20,
+        collect_stats=args.stats or args.stats_json is not None,
+        phase_hooks=phase_hooks,
+        snapshot_file=args.snapshot,
+        trace_slice=trace_slice,
+        index_dir=args.index_dir,
+        message_types_file=args.message_types,
+        impact_map_file=args.impact_map,
+        test_markers=args.test_markers,
+        test_times=args.test_times,
+        results_file=args.results,
+        changed_lines=changed_lines,
+    )
+    if args.list_messages:
+        sys.stdout.writelines(evaluator.iter_message_list())
+        if args.reportFileName is None and args.snapshot is None and args.impact_map is None:
+            return
+    if args.follow:
+        print(f"Following {', '.join(str(p) for p in evaluator.trace_logs)}; press Ctrl+C to stop")
+        try:
+            evaluator.follow(args.interval, [args.userTraceFile] + args.trace)
+        except KeyboardInterrupt:
+            pass
+    else:
+        evaluator.run()
+    print_outputs(evaluator, args.stats_json)
+    if profile_hook is not None and profile_hook.written:
+        print(f"Profile of phase '{args.profile}' written to {profile_out} (view with: python -m pstats {profile_out})")
+    exit_code = 0
+    if args.diff is not None or args.changed:
+        changed = evaluator.changed_line_coverage()
+        covered = sum(1 for line in changed if line[3])
+        percent = covered / len(changed) * 100 if changed else 100.0
+        print(f"\nChanged lines: {covered} of {len(changed)} executable lines covered ({percent:.1f}%)")
+        if args.changed_report:
+            with args.changed_report.open("w", encoding="utf-8") as f:
+                f.writelines(evaluator.iter_changed_lines_report())
+            print(f"Coverage of the changed lines written to {args.changed_report}")
+        if args.fail_under is not None and percent < args.fail_under:
+            print(f"Coverage of the changed lines is below {args.fail_under:g}%")
+            exit_code = 1
+    print("\nSupportPac IAM2, Version 1.0.6 (Python port)")
+    sys.exit(exit_code)
+
+
+def trace_time_arg(text: str) -> str:
+    try:
+        parse_trace_time(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a timestamp like '2008-04-23 14:22:30.5': {text}")
+    return text
+
+
+def merge_main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="evaluator.py merge", description="Combine coverage snapshots written with --snapshot (e.g. by sharded CI runs) into one text report, SonarQube XML and/or snapshot.")
+    parser.add_argument("sourceCodeFile", type=Path, help="The ESQL source/CMF file or directory the snapshots were taken from")
+    parser.add_argument("snapshots", nargs="+", help="Snapshot files or globs such as 'shards/*.snap' (quoted, for thousands of files)")
+    parser.add_argument("--report", type=Path, default=None, metavar="FILE", help="Output text report")
+    parser.add_argument("--sonar-coverage-xml", type=Path, default=None, help="Optional path to write SonarQube Generic Test Coverage XML (coverage version=1)")
+    parser.add_argument("--snapshot", type=Path, default=None, metavar="FILE", help="Write the merged snapshot, e.g. to merge it again further up")
+    parser.add_argument("--filter-modules", type=Path, default=Path("filterModules.txt"), help="Optional file listing modules to filter out")
+    parser.add_argument("--filter-funcs", type=Path, default=Path("filterFunctionProcedure.txt"), help="Optional file listing procedures/functions to filter out")
+    parser.add_argument("--hit-counts", action="store_true", help="Show how often each traced line was executed in the report details")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes for parsing project sources (default: one per CPU)")
+    parser.add_argument("--cache-dir", type=Path, default=None, help="Directory caching the parsed ESQL sources; unchanged sources are not parsed again")
+    parser.add_argument("--cache-mb", type=int, default=DEFAULT_SOURCE_CACHE_SIZE >> 20, help="Size limit of --cache-dir in MB; least recently used entries are evicted (default: 256)")
+    parser.add_argument("--stats", action="store_true", help="Print wall/CPU time, peak memory and counters per phase")
+    parser.add_argument("--stats-json", type=Path, default=None, metavar="FILE", help="Write the --stats metrics as JSON (implies --stats)")
+
+    args = parser.parse_args(argv)
+    if args.report is None and args.sonar_coverage_xml is None and args.snapshot is None:
+        parser.error("nothing to write: give --report, --sonar-coverage-xml and/or --snapshot")
+
+    evaluator = ESQLCoverageEvaluator(
+        trace_log=[],
+        esql_source=args.sourceCodeFile,
+        report_file=args.report,
+        filter_modules_file=args.filter_modules,
+        filter_funcs_file=args.filter_funcs,
+        sonar_coverage_xml=args.sonar_coverage_xml,
+        show_hit_counts=args.hit_counts,
+        workers=args.workers,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_mb << 20,
+        collect_stats=args.stats or args.stats_json is not None,
+        snapshot_file=args.snapshot,
+        snapshots=expand_trace_paths(args.snapshots, kind="snapshot"),
     )
     evaluator.run()
-    print(f"\nReport has been written to {args.reportFileName}")
-    if args.sonar_coverage_xml:
-        print(f"SonarQube Generic Coverage XML written to {args.sonar_coverage_xml}")
+    print_outputs(evaluator, args.stats_json)
     print("\nSupportPac IAM2, Version 1.0.6 (Python port)")
 
 
+def impact_main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="evaluator.py impact", description="Select the test cases to run for changed ESQL lines, from a map written with --impact-map. Prints one test per line.")
+    parser.add_argument("impactMap", type=Path, help="JSON map written with --impact-map")
+    parser.add_argument("--changed", action="append", default=[], required=True, metavar="SOURCE:LINES", help="Changed lines, e.g. 'Transformation_Compute.esql:10-20,25' (repeatable)")
+    parser.add_argument("--fail-uncovered", action="store_true", help="Exit with code 1 if a changed executable line is covered by no test")
+    args = parser.parse_args(argv)
+
+    impact_map = json.loads(args.impactMap.read_text(encoding="utf-8"))
+    if impact_map.get("version") != IMPACT_MAP_VERSION:
+        parser.error(f"unsupported impact map version: {impact_map.get('version')}")
+    changed: Dict[str, Set[int]] = {}
+    for spec in args.changed:
+        try:
+            source, lines = parse_line_spec(spec)
+        except ValueError as e:
+            parser.error(str(e))
+        changed.setdefault(source, set()).update(lines)
+    selected, uncovered = select_tests(impact_map, changed)
+    for test in selected:
+        print(test)
+    for source, lines in uncovered.items():
+        print(f"Not covered by any test: {source}: {', '.join(map(str, lines))}", file=sys.stderr)
+    print(f"{len(selected)} of {len(impact_map['tests'])} tests selected", file=sys.stderr)
+    return 1 if args.fail_uncovered and uncovered else 0
+
+
+def serve_main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="evaluator.py serve", description="Keep parsed ESQL projects in memory and evaluate traces sent over HTTP (TCP or a Unix socket).")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_SERVER_PORT, help=f"TCP port (default: {DEFAULT_SERVER_PORT})")
+    parser.add_argument("--socket", type=Path, default=None, metavar="PATH", help="Listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=4, help="Requests evaluated at the same time (default: 4)")
+    parser.add_argument("--trace-workers", type=int, default=1, help="Worker processes per evaluation for trace files/shards and project sources (default: 1)")
+    parser.add_argument("--max-projects", type=int, default=8, help="Prepared projects kept in memory; least recently used ones are dropped (default: 8)")
+    parser.add_argument("--pattern", type=Path, default=Path("tracelog.pattern"), help="Default tracelog.pattern of requests")
+    parser.add_argument("--filter-modules", type=Path, default=Path("filterModules.txt"), help="Default module filter file of requests")
+    parser.add_argument("--filter-funcs", type=Path, default=Path("filterFunctionProcedure.txt"), help="Default function/procedure filter file of requests")
+    parser.add_argument("--parser", choices=TRACE_PARSERS, default="regex", help="Default trace line parser of requests")
+    parser.add_argument("--cache-dir", type=Path, default=None, help="Directory caching the parsed ESQL sources across server restarts")
+    parser.add_argument("--cache-mb", type=int, default=DEFAULT_SOURCE_CACHE_SIZE >> 20, help="Size limit of --cache-dir in MB (default: 256)")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args(argv)
+
+    projects = ProjectCache(args.max_projects, args.trace_workers, args.cache_dir, args.cache_mb << 20)
+    defaults = {"pattern": args.pattern, "filter_modules": args.filter_modules,
+                "filter_funcs": args.filter_funcs, "parser": args.parser}
+    if args.socket is not None:
+        if CoverageUnixServer is None:
+            parser.error("Unix sockets are not available on this platform")
+        if args.socket.exists():
+            args.socket.unlink()
+        server = CoverageUnixServer(str(args.socket), CoverageRequestHandler)
+        where = f"unix socket {args.socket}"
+    else:
+        server = CoverageHTTPServer((args.host, args.port), CoverageRequestHandler)
+        where = f"http://{args.host}:{server.server_address[1]}"
+    server.init_pool(args.workers, projects, defaults, args.verbose)
+    # SIGTERM (e.g. from a service manager) stops the server like Ctrl+C, removing the socket file
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Coverage server listening on {where}; press Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and args.socket.exists():
+            args.socket.unlink()
+
+
+def print_outputs(evaluator: ESQLCoverageEvaluator, stats_json: Path | None) -> None:
+    """Tell where the outputs went and print the --stats summary."""
+    if evaluator.report_file is not None:
+        print(f"\nReport has been written to {evaluator.report_file}")
+    if evaluator.sonar_coverage_xml:
+        print(f"SonarQube Generic Coverage XML written to {evaluator.sonar_coverage_xml}")
+    if evaluator.snapshot_file:
+        print(f"Coverage snapshot written to {evaluator.snapshot_file}")
+    if evaluator.message_types_file:
+        print(f"Traced functions per message type written to {evaluator.message_types_file}")
+    if evaluator.impact_map_file:
+        print(f"Test impact map written to {evaluator.impact_map_file}")
+    if evaluator.stats is not None:
+        print()
+        print("\n".join(evaluator.stats.summary()))
+        if stats_json:
+            stats_json.write_text(json.dumps(evaluator.stats.as_dict(), indent=2) + "\n", encoding="utf-8")
+            print(f"Metrics written to {stats_json}")
+
+
 if __name__ == "__main__":
     main()
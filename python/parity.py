@@ -0,0 +1,404 @@
+from __future__ import annotations
+import argparse
+import difflib
+import json
+import os
+import random
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+from benchmark import TRACE_STYLES, generate_esql, generate_trace, write_lines
+
+HERE = Path(__file__).resolve().parent
+ROOT = HERE.parent
+PERL_DIR = ROOT / "perl"
+SAMPLE_DIR = ROOT / "sample"
+# Seconds between two reads of a running evaluator's peak RSS
+RSS_POLL_INTERVAL = 0.02
+
+# -----------------------------
+# Implementations
+# -----------------------------
+
+class Implementation(NamedTuple):
+    """One evaluator: a command taking <trace> <source> <report>, run in cwd."""
+    name: str
+    command: List[str]
+    cwd: Path
+    extra_args: List[str] = []
+
+    def argv(self, trace: Path, esql: Path, report: Path) -> List[str]:
+        return self.command + [str(trace), str(esql), str(report)] + self.extra_args
+
+
+def perl_implementation(script: str) -> Implementation:
+    # The Perl scripts read tracelog.pattern and the filter files from the working directory
+    return Implementation(f"perl/{script}", ["perl", str(PERL_DIR / script)], PERL_DIR)
+
+
+def python_implementation(evaluator: Path, name: str, extra_args: Sequence[str] = ()) -> Implementation:
+    # Same filter files as the Perl scripts, so both evaluate the same functions
+    return Implementation(name, [sys.executable, str(evaluator)], evaluator.parent, [
+        "--pattern", str(evaluator.parent / "tracelog.pattern"),
+        "--filter-modules", str(PERL_DIR / "filterModules.txt"),
+        "--filter-funcs", str(PERL_DIR / "filterFunctionProcedure.txt"),
+        *extra_args])
+
+
+def implementations(args: argparse.Namespace) -> List[Implementation]:
+    out: List[Implementation] = []
+    if not args.skip_perl:
+        if shutil.which("perl") is None:
+            print("Warning: perl not found, only the Python evaluator is run", file=sys.stderr)
+        else:
+            out += [perl_implementation("evaluator.pl"), perl_implementation("evaluator-non-en_US.pl")]
+    out.append(python_implementation(HERE / "evaluator.py", "python/evaluator.py"))
+    for extra in args.python_args:
+        out.append(python_implementation(HERE / "evaluator.py", f"python/evaluator.py {extra}", shlex.split(extra)))
+    if args.baseline_evaluator is not None:
+        out.append(python_implementation(args.baseline_evaluator.resolve(), f"baseline:{args.baseline_evaluator}"))
+    return out
+
+
+# -----------------------------
+# Inputs
+# -----------------------------
+
+class Input(NamedTuple):
+    name: str
+    trace: Path
+    esql: Path
+
+
+def sample_inputs() -> List[Input]:
+    """Every trace of every sample directory with each ESQL file next to it."""
+    out = []
+    for directory in sorted(p for p in SAMPLE_DIR.iterdir() if p.is_dir()):
+        for esql in sorted(directory.glob("*.esql")):
+            for trace in sorted(p for p in directory.glob("*.txt") if "trace" in p.name.lower()):
+                out.append(Input(f"{directory.name}/{trace.name}", trace, esql))
+    return out
+
+
+def generated_input(args: argparse.Namespace, workdir: Path) -> Input:
+    rng = random.Random(args.seed)
+    src, functions = generate_esql(rng, args.schemas, args.modules, args.procedures, args.depth)
+    esql = workdir / "generated.esql"
+    trace = workdir / "generated.trace.txt"
+    write_lines(esql, src)
+    write_lines(trace, generate_trace(rng, functions, args.hits, args.noise, args.style))
+    return Input(f"generated (seed {args.seed}, {len(functions)} functions, {args.hits} hits)", trace, esql)
+
+
+# -----------------------------
+# Running
+# -----------------------------
+
+class RunResult(NamedTuple):
+    seconds: float
+    peak_rss_kb: int | None
+    error: str | None
+
+
+class _Watcher(threading.Thread):
+    """Kills a process after a timeout and samples its high-water RSS (VmHWM) from /proc.
+
+    ru_maxrss of a child also counts the memory it shared with this process before exec,
+    so on Linux the evaluator's own peak is read while it runs. Runs too short to be
+    sampled fall back to ru_maxrss, an upper bound.
+    """
+
+    def __init__(self, process: subprocess.Popen, timeout: float):
+        super().__init__(daemon=True)
+        self.process = process
+        self.deadline = time.perf_counter() + timeout
+        self.done = threading.Event()
+        self.timed_out = False
+        self.peak_rss_kb: int | None = None
+
+    def run(self) -> None:
+        status = Path(f"/proc/{self.process.pid}/status")
+        while not self.done.wait(RSS_POLL_INTERVAL):
+            if time.perf_counter() > self.deadline:
+                self.timed_out = True
+                self.process.kill()
+                return
+            try:
+                for line in status.read_text().splitlines():
+                    if line.startswith("VmHWM:"):
+                        self.peak_rss_kb = max(int(line.split()[1]), self.peak_rss_kb or 0)
+            except (OSError, ValueError):
+                pass
+
+
+def run(impl: Implementation, inp: Input, report: Path, timeout: float) -> RunResult:
+    """Run one evaluator in its own process; wall time and the peak RSS of that process."""
+    err_path = report.with_suffix(".err")
+    with err_path.open("wb") as err:
+        start = time.perf_counter()
+        process = subprocess.Popen(impl.argv(inp.trace, inp.esql, report), cwd=impl.cwd,
+                                   stdout=subprocess.DEVNULL, stderr=err)
+        watcher = _Watcher(process, timeout)
+        watcher.start()
+        rss = None
+        try:
+            if hasattr(os, "wait4"):
+                _, status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                rss = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+            else:
+                process.wait()
+        finally:
+            watcher.done.set()
+            watcher.join()
+        seconds = time.perf_counter() - start
+    rss = watcher.peak_rss_kb or rss
+    timed_out = watcher.timed_out
+    if timed_out:
+        return RunResult(seconds, rss, f"timed out after {timeout:.0f}s")
+    if process.returncode != 0 or not report.exists():
+        message = err_path.read_text(encoding="utf-8", errors="replace").strip().splitlines()
+        return RunResult(seconds, rss, f"exit code {process.returncode}: {message[-1] if message else 'no report'}")
+    return RunResult(seconds, rss, None)
+
+
+# -----------------------------
+# Report parsing
+# -----------------------------
+
+# Both implementations write the same layout; only the padding before ':' differs
+RE_OVERVIEW_LINES = re.compile(r"^Lines\s*:\s*(\d+) \((\d+) comment and (\d+) blank lines\)")
+RE_OVERVIEW_EXECUTED = re.compile(r"^Executed Lines\s*:\s*(\d+) of (\d+) executable lines")
+RE_DETAILS_HEADER = re.compile(r"^ESQL Function / Procedure \d+: '(.*)'$")
+# '[x] 5: ...', '[x] (hits: 42) 5: ...', '[ ] 5: ...' or a comment/blank line '    5: ...'
+RE_DETAILS_LINE = re.compile(r"^(?:\[([x ])\] (?:\(hits: \d+\) )?| +)(\d+): (.*)$")
+
+
+class FunctionReport(NamedTuple):
+    lines: int
+    executed: int
+    executable: int
+    # (marker, source text): 'x' executed, ' ' not executed, '-' comment or blank
+    markers: List[Tuple[str, str]]
+
+
+def parse_report(path: Path) -> Dict[str, FunctionReport]:
+    """Per-function counts (overview) and line markers (details) of a text report.
+
+    Functions reported more than once (e.g. the same name in several schemas) get '#2', '#3'... appended.
+    """
+    counts: Dict[str, List[Tuple[int, int, int]]] = {}
+    markers: Dict[str, List[List[Tuple[str, str]]]] = {}
+    label = None
+    current: List[Tuple[str, str]] | None = None
+    lines_total = 0
+    for line in path.read_text(encoding="utf-8", errors="replace").splitlines():
+        m = RE_DETAILS_HEADER.match(line)
+        if m:
+            current = []
+            markers.setdefault(m.group(1), []).append(current)
+            continue
+        if current is not None:
+            m = RE_DETAILS_LINE.match(line)
+            if m:
+                current.append((m.group(1) or "-", m.group(3).strip()))
+            continue
+        if line.startswith("'") and line.endswith("'"):
+            label = line[1:-1]
+            continue
+        m = RE_OVERVIEW_LINES.match(line)
+        if m and label is not None:
+            lines_total = int(m.group(1))
+            continue
+        m = RE_OVERVIEW_EXECUTED.match(line)
+        if m and label is not None:
+            counts.setdefault(label, []).append((lines_total, int(m.group(1)), int(m.group(2))))
+            label = None
+    out: Dict[str, FunctionReport] = {}
+    for name in counts.keys() | markers.keys():
+        entries = counts.get(name, [])
+        details = markers.get(name, [])
+        for i in range(max(len(entries), len(details))):
+            lines_total, executed, executable = entries[i] if i < len(entries) else (0, 0, 0)
+            key = name if i == 0 else f"{name}#{i + 1}"
+            out[key] = FunctionReport(lines_total, executed, executable, details[i] if i < len(details) else [])
+    return out
+
+
+# -----------------------------
+# Comparison
+# -----------------------------
+
+def diff_markers(ref: List[Tuple[str, str]], other: List[Tuple[str, str]]) -> List[str]:
+    """Differences of two functions' line markers, lines aligned by their source text.
+
+    Aligning by text rather than line number keeps one extra line (e.g. a CREATE FUNCTION
+    header shown by one implementation only) from shifting every marker after it.
+    """
+    out = []
+    matcher = difflib.SequenceMatcher(None, [t for _, t in ref], [t for _, t in other], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for (a, text), (b, _) in zip(ref[i1:i2], other[j1:j2]):
+                if a != b:
+                    out.append(f"[{a}] -> [{b}] {text}")
+            continue
+        for a, text in ref[i1:i2]:
+            out.append(f"[{a}] only in reference: {text}")
+        for b, text in other[j1:j2]:
+            out.append(f"[{b}] only here: {text}")
+    return out
+
+
+def compare_reports(ref: Dict[str, FunctionReport], other: Dict[str, FunctionReport]) -> Dict[str, List[str]]:
+    """Function -> differences; functions without differences are left out."""
+    out: Dict[str, List[str]] = {}
+    for name in sorted(ref.keys() | other.keys(), key=str.lower):
+        if name not in other:
+            out[name] = ["function missing"]
+            continue
+        if name not in ref:
+            out[name] = ["function not in reference"]
+            continue
+        a, b = ref[name], other[name]
+        diffs = []
+        if (a.executed, a.executable) != (b.executed, b.executable):
+            diffs.append(f"executed {a.executed} of {a.executable} -> {b.executed} of {b.executable}")
+        diffs += diff_markers(a.markers, b.markers)
+        if diffs:
+            out[name] = diffs
+    return out
+
+
+# -----------------------------
+# Harness
+# -----------------------------
+
+def evaluate_input(inp: Input, impls: List[Implementation], reference: str, workdir: Path,
+                   args: argparse.Namespace) -> dict:
+    trace_bytes = inp.trace.stat().st_size
+    with inp.trace.open("rb") as f:
+        trace_lines = sum(1 for _ in f)
+    runs = {}
+    reports: Dict[str, Dict[str, FunctionReport]] = {}
+    for n, impl in enumerate(impls):
+        best: RunResult | None = None
+        report = workdir / f"report-{n}.txt"
+        for _ in range(args.repeat):
+            result = run(impl, inp, report, args.timeout)
+            if result.error is not None:
+                best = result
+                break
+            best = result if best is None or result.seconds < best.seconds else best
+        runs[impl.name] = {
+            "seconds": round(best.seconds, 6),
+            "trace_lines_per_second": round(trace_lines / best.seconds) if best.seconds else None,
+            "mb_per_second": round(trace_bytes / (1 << 20) / best.seconds, 3) if best.seconds else None,
+            "peak_rss_kb": best.peak_rss_kb,
+            "error": best.error,
+        }
+        if best.error is None:
+            reports[impl.name] = parse_report(report)
+    parity = {}
+    if reference in reports:
+        for name, report in reports.items():
+            if name != reference:
+                diffs = compare_reports(reports[reference], report)
+                parity[name] = {"functions": len(reports[reference].keys() | report.keys()), "differing_functions": len(diffs), "differences": diffs}
+    return {"input": inp.name, "trace_lines": trace_lines, "trace_bytes": trace_bytes,
+            "functions": len(reports.get(reference, {})), "runs": runs, "parity": parity}
+
+
+def print_input_result(result: dict, reference: str, show: int) -> None:
+    print(f"\n== {result['input']}: {result['trace_lines']} trace lines, {result['trace_bytes'] >> 10} KB")
+    print(f"{'implementation':<40}{'seconds':>9}{'lines/s':>12}{'MB/s':>8}{'RSS MB':>8}  parity")
+    for name, run_result in result["runs"].items():
+        if run_result["error"] is not None:
+            status = f"FAILED ({run_result['error']})"
+        elif name == reference:
+            status = f"reference, {result['functions']} functions"
+        else:
+            p = result["parity"].get(name)
+            status = "identical" if p and not p["differing_functions"] else \
+                f"{p['differing_functions']} of {p['functions']} functions differ" if p else "-"
+        rss = run_result["peak_rss_kb"]
+        print(f"{name:<40}{run_result['seconds']:>9.3f}{run_result['trace_lines_per_second'] or 0:>12,}"
+              f"{run_result['mb_per_second'] or 0:>8.2f}{rss / 1024 if rss else 0:>8.1f}  {status}")
+    for name, p in result["parity"].items():
+        for function, diffs in list(p["differences"].items())[:show]:
+            print(f"  {name}: '{function}'")
+            for line in diffs[:show]:
+                print(f"    {line}")
+            if len(diffs) > show:
+                print(f"    ... {len(diffs) - show} more")
+        if p["differing_functions"] > show:
+            print(f"  {name}: ... {p['differing_functions'] - show} more functions differ")
+
+
+# -----------------------------
+# CLI
+# -----------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the Perl and Python evaluators: per-function parity, throughput and memory.")
+    parser.add_argument("--reference", default=None, help="Implementation the others are compared with (default: the first, perl/evaluator.pl)")
+    parser.add_argument("--skip-perl", action="store_true", help="Run only the Python evaluator(s), e.g. to compare --python-args variants")
+    parser.add_argument("--python-args", action="append", default=[], metavar="ARGS", help="Also run python/evaluator.py with these options, e.g. '--parser fast' (repeatable)")
+    parser.add_argument("--baseline-evaluator", type=Path, default=None, help="Also run this evaluator.py, e.g. from a checkout before an optimisation")
+    parser.add_argument("--skip-samples", action="store_true", help="Do not run the sample/ inputs")
+    parser.add_argument("--skip-generated", action="store_true", help="Do not run the generated input")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed of the generated input")
+    parser.add_argument("--schemas", type=int, default=2, help="Schemas in the generated source")
+    parser.add_argument("--modules", type=int, default=10, help="Compute modules per schema")
+    parser.add_argument("--procedures", type=int, default=8, help="Functions/procedures per module")
+    parser.add_argument("--depth", type=int, default=4, help="Maximum nesting of IF/CASE/LOOP/... blocks")
+    parser.add_argument("--hits", type=int, default=200000, help="Statement records in the generated trace")
+    parser.add_argument("--noise", type=float, default=0.5, help="Share of trace lines that are not statement records (0..1)")
+    parser.add_argument("--style", choices=TRACE_STYLES, default="user", help="UserTrace, ServiceTrace or mixed statement records")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per implementation and input; the fastest is reported")
+    parser.add_argument("--timeout", type=float, default=600.0, help="Seconds a run may take (default: 600)")
+    parser.add_argument("--show", type=int, default=5, help="Differing functions, and differences per function, printed (default: 5)")
+    parser.add_argument("--workdir", type=Path, default=None, help="Keep the generated input and the reports here (default: a temporary directory)")
+    parser.add_argument("--json", type=Path, default=None, help="Write the results, with all differences, as JSON")
+    parser.add_argument("--fail-on-diff", action="store_true", help="Exit with code 1 if an implementation fails or differs from the reference")
+    args = parser.parse_args()
+    if not 0 <= args.noise < 1:
+        parser.error("--noise must be at least 0 and below 1")
+
+    impls = implementations(args)
+    reference = args.reference or impls[0].name
+    if reference not in {impl.name for impl in impls}:
+        parser.error(f"unknown --reference '{reference}', expected one of: {', '.join(impl.name for impl in impls)}")
+
+    with tempfile.TemporaryDirectory(prefix="esql-parity-") as tmp:
+        workdir = args.workdir or Path(tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        inputs = [] if args.skip_samples else sample_inputs()
+        if not args.skip_generated:
+            inputs.append(generated_input(args, workdir))
+        results = []
+        for n, inp in enumerate(inputs):
+            run_dir = workdir / f"input-{n}"
+            run_dir.mkdir(exist_ok=True)
+            result = evaluate_input(inp, impls, reference, run_dir, args)
+            print_input_result(result, reference, args.show)
+            results.append(result)
+
+    if args.json is not None:
+        args.json.write_text(json.dumps({"reference": reference, "inputs": results}, indent=2) + "\n", encoding="utf-8")
+    failed = any(r["error"] for result in results for r in result["runs"].values())
+    differs = any(p["differing_functions"] for result in results for p in result["parity"].values())
+    if args.fail_on_diff and (failed or differs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
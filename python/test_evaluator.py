@@ -0,0 +1,178 @@
+"""Regression tests of evaluator.py (python -m unittest, from this directory)."""
+from __future__ import annotations
+import http.client
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Tuple
+
+from evaluator import (CoverageHTTPServer, CoverageRequestHandler, ESQLCoverageEvaluator, ProjectCache,
+                       parse_trace_time, read_test_windows)
+
+HERE = Path(__file__).resolve().parent
+SAMPLE = HERE.parent / "sample"
+PATTERN = HERE / "tracelog.pattern"
+
+
+def executed_lines(evaluator: ESQLCoverageEvaluator) -> int:
+    return sum(stats[0] for stats in evaluator.esql_module_func_stats.values())
+
+
+class RendezvousEvaluator(ESQLCoverageEvaluator):
+    """Evaluator whose forks meet at a barrier in their first source, so their requests overlap."""
+
+    barrier: threading.Barrier | None = None
+
+    def _evaluate_source(self, model):
+        if self.barrier is not None:
+            barrier, self.barrier = self.barrier, None
+            barrier.wait(timeout=10)
+        return super()._evaluate_source(model)
+
+
+class ConcurrentForkTest(unittest.TestCase):
+    """Forks of one prepared project evaluated on threads, as the coverage server does."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.empty_trace = Path(self.tmp.name) / "empty.txt"
+        self.empty_trace.write_text("")
+        self.trace = SAMPLE / "MessageRouting" / "MessageRoutingSampleTrace.txt"
+        # Two sources, so a request still has one to evaluate after the other request started
+        project_dir = Path(self.tmp.name) / "project"
+        project_dir.mkdir()
+        for name in ("a.esql", "b.esql"):
+            shutil.copy(SAMPLE / "MessageRouting" / "Routing_using_memory_cache.esql", project_dir / name)
+        self.project = RendezvousEvaluator([], project_dir, None, pattern_file=PATTERN, workers=1)
+        self.project.prepare()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_concurrent_requests_keep_their_own_coverage(self):
+        expected = {}
+        for trace in (self.trace, self.empty_trace):
+            fork = self.project.fork([trace])
+            fork.evaluate()
+            expected[trace] = executed_lines(fork)
+        self.assertGreater(expected[self.trace], 0)
+        self.assertEqual(expected[self.empty_trace], 0)
+
+        # Each request waits in its first source until the other one has started evaluating
+        barrier = threading.Barrier(2)
+
+        def request(trace: Path) -> int:
+            fork = self.project.fork([trace])
+            fork.barrier = barrier
+            fork.evaluate()
+            return executed_lines(fork)
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            for _ in range(5):
+                traced = pool.submit(request, self.trace)
+                empty = pool.submit(request, self.empty_trace)
+                self.assertEqual(traced.result(), expected[self.trace])
+                self.assertEqual(empty.result(), expected[self.empty_trace])
+
+
+
+class ChangedLinesTest(unittest.TestCase):
+    """--diff/--changed paths name one file, not every source with the same file name."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repo = Path(self.tmp.name)
+        (self.repo / ".git").mkdir()
+        for directory in ("MessageRouting", "MessageRouting_v11"):
+            (self.repo / directory).mkdir()
+            shutil.copy(SAMPLE / directory / "Routing_using_memory_cache.esql", self.repo / directory)
+        self.source = self.repo / "MessageRouting" / "Routing_using_memory_cache.esql"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def changed(self, path: str) -> dict:
+        evaluator = ESQLCoverageEvaluator([], self.source, None, pattern_file=PATTERN,
+                                          changed_lines={path: {10, 11}})
+        return evaluator.changed_lines
+
+    def test_same_named_file_in_another_directory_is_not_matched(self):
+        self.assertEqual(self.changed("MessageRouting_v11/Routing_using_memory_cache.esql"), {})
+        self.assertEqual(self.changed(str(self.repo / "MessageRouting_v11" / "Routing_using_memory_cache.esql")), {})
+
+    def test_paths_relative_to_the_repository_or_absolute_are_matched(self):
+        expected = {"Routing_using_memory_cache.esql": {10, 11}}
+        self.assertEqual(self.changed("MessageRouting/Routing_using_memory_cache.esql"), expected)
+        self.assertEqual(self.changed(str(self.source)), expected)
+
+
+
+class ServerRequestTest(unittest.TestCase):
+    """Malformed /evaluate requests are answered with 400, not a server error."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = CoverageHTTPServer(("127.0.0.1", 0), CoverageRequestHandler)
+        defaults = {"pattern": PATTERN, "filter_modules": Path("filterModules.txt"),
+                    "filter_funcs": Path("filterFunctionProcedure.txt"), "parser": "regex"}
+        cls.server.init_pool(2, ProjectCache(2), defaults, verbose=False)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def post(self, body) -> Tuple[int, dict]:
+        connection = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=30)
+        try:
+            connection.request("POST", "/evaluate", json.dumps(body), {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def test_valid_request(self):
+        status, result = self.post({"source": str(SAMPLE / "Transformation_ESQL" / "Transformation_Compute.esql"),
+                                    "traces": [str(SAMPLE / "Transformation_ESQL" / "Transformation_ESQL_Trace.txt")]})
+        self.assertEqual(status, 200, result)
+
+    def test_malformed_requests(self):
+        valid = {"source": str(SAMPLE / "Transformation_ESQL" / "Transformation_Compute.esql"),
+                 "traces": [str(SAMPLE / "Transformation_ESQL" / "Transformation_ESQL_Trace.txt")]}
+        bodies = [[], "trace.txt", {"traces": valid["traces"]}]
+        for name, value in [("source", 3), ("traces", 5), ("traces", [1]), ("format", {}), ("format", "pdf"),
+                            ("parser", {"a": 1}), ("parser", "slow"), ("pattern", ["x"]),
+                            ("filter_modules", 1), ("filter_funcs", {"a": 1}), ("hit_counts", [])]:
+            bodies.append(dict(valid, **{name: value}))
+        for body in bodies:
+            with self.subTest(body=body):
+                status, result = self.post(body)
+                self.assertEqual(status, 400, result)
+
+
+
+class TraceTimeTest(unittest.TestCase):
+    """Timestamps with fractions of any length, also where fromisoformat only takes 3 or 6 digits."""
+
+    def test_fractions_are_padded_or_cut_to_microseconds(self):
+        self.assertEqual(parse_trace_time("2008-04-23 14:22:30.5").microsecond, 500000)
+        self.assertEqual(parse_trace_time("2008-04-23 14:22:30.46").microsecond, 460000)
+        self.assertEqual(parse_trace_time("2008-04-23 14:22:30.4656049").microsecond, 465604)
+        self.assertEqual(parse_trace_time(" 2008-04-23 14:22 ").minute, 22)
+
+    def test_test_windows(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "times.tsv"
+            path.write_text("tA\t2008-04-23 14:22:30.5\t2008-04-23 14:22:31.0469\n")
+            self.assertEqual(read_test_windows(path),
+                             [("tA", "2008-04-23 14:22:30.500000", "2008-04-23 14:22:31.046900")])
+
+
+if __name__ == "__main__":
+    unittest.main()